@@ -1,17 +1,36 @@
 import json
 import logging
+import tempfile
 from json import JSONDecodeError
 
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from ninja import Field, NinjaAPI, Schema
 from ninja.errors import HttpError
-from reldatasync.datastore import Datastore, NoSuchTable
+from reldatasync import util
+from reldatasync.changefeed import notifier
+from reldatasync.datastore import (
+    Datastore,
+    MultiTableDatastore,
+    NoSuchTable,
+    ResyncRequired,
+)
 from reldatasync.document import Document
 from reldatasync_app.models import DataSyncRevisions, SyncableModel
+from reldatasync_app.registry import registry
 
 api = NinjaAPI()
 
 logger = logging.getLogger(__name__)
 
+# Longest a client may wait for changes in one request, in seconds
+CHANGES_MAX_TIMEOUT = 60
+# How often waiting for changes re-reads the sequence id, in seconds.
+# Writes in this process wake waiters right away, but writes in other
+# processes are only seen when we re-read.
+CHANGES_POLL_INTERVAL = 1.0
+# Snapshots bigger than this many bytes go to a temp file, not memory
+SNAPSHOT_MAX_MEMORY = 10 * 1024 * 1024
+
 
 def _get_datastore(datastore_name: str, table_name: str) -> Datastore:
     try:
@@ -20,6 +39,14 @@ def _get_datastore(datastore_name: str, table_name: str) -> Datastore:
         raise HttpError(404, f"Datastore {datastore_name} not found")
 
 
+def _get_table(object_name: str) -> str:
+    """Return the db table of a SyncableModel class name, or raise 403."""
+    info = registry.get_by_class_name(object_name)
+    if not info:
+        raise HttpError(403, f"Unknown table '{object_name}'")
+    return info.db_table
+
+
 class DatastoreSchema(Schema):
     id: str = Field(alias="datastore_id")
     name: str = Field(alias="datastore_name")
@@ -38,9 +65,7 @@ def get_doc(
 
     :param: `include_deleted`: if true, include deleted docs.  Default: false.
     """
-    table = SyncableModel.get_table_by_class_name(object_name)
-    if not table:
-        raise HttpError(403, f"Unknown table '{object_name}'")
+    table = _get_table(object_name)
     with _get_datastore(datastore, table) as datastore1:
         ret = datastore1.get(docid, include_deleted=include_deleted)
         if not ret:
@@ -58,9 +83,7 @@ def post_doc(request, datastore: str, object_name: str, increment_rev: bool = Fa
     :return `{"document": doc, "num_docs_put": <int>}`.
     """
     try:
-        table = SyncableModel.get_table_by_class_name(object_name)
-        if not table:
-            raise HttpError(403, f"Unknown table '{object_name}'")
+        table = _get_table(object_name)
         with _get_datastore(datastore, table) as datastore1:
             # django-ninja can't parse because we don't have a schema
             data = _get_json_body(request)
@@ -70,6 +93,7 @@ def post_doc(request, datastore: str, object_name: str, increment_rev: bool = Fa
                 )
             except ValueError as err:
                 raise HttpError(422, str(err))
+            SyncableModel.notify_sequence_id(datastore, datastore1.sequence_id)
             return {"num_docs_put": num_put, "document": new_doc}
     except NoSuchTable:
         logger.warning(f"Table '{table}' not found")
@@ -89,36 +113,158 @@ def _get_json_body(request):
     return data
 
 
+def _docs_etag(
+    datastore_name: str,
+    start_sequence_id: int,
+    chunk_size: int,
+    where=None,
+    deltas=False,
+):
+    """Return the ETag for a get_docs chunk, or None if there is no datastore yet.
+
+    This costs one query (see SyncableModel.read_sequence_id), so we can
+    answer 304 without setting up a datastore.
+    """
+    row = SyncableModel.read_sequence_id(datastore_name)
+    if not row:
+        return None
+    return util.docs_etag(row[0], row[1], start_sequence_id, chunk_size, where, deltas)
+
+
+def _get_where(where: str):
+    """Parse the where query parameter, or raise 422."""
+    try:
+        return util.parse_where(where)
+    except ValueError as err:
+        raise HttpError(422, str(err))
+
+
+def _ack_peer(datastore_name: str, table_name: str, peer_id: str, the_seq: int):
+    """Record that peer_id has pulled up to the_seq, or raise 410 if it
+    missed purged tombstones."""
+    with _get_datastore(datastore_name, table_name) as datastore1:
+        try:
+            datastore1.check_peer_sequence_id(the_seq)
+        except ResyncRequired as err:
+            raise HttpError(410, str(err))
+        datastore1.ack_peer_sequence_id(peer_id, the_seq)
+
+
 @api.get("{datastore}/{object_name}/docs", response=dict)
+# pylint: disable-next=too-many-positional-arguments
 def get_docs(
     request,
+    response: HttpResponse,
     datastore: str,
     object_name: str,
     start_sequence_id: int,
     chunk_size: int = 100,
+    peer_id: str = None,
+    where: str = None,
+    deltas: bool = False,
 ):
     """GET docs with `start_sequence_id < _seq <= (start_sequence_id+chunk_size)`
 
-    Return `{"current_sequence_id": cur_seq_id, "documents": the_docs}`
+    Return `{"current_sequence_id": cur_seq_id, "documents": the_docs}`,
+    with an ETag header.  If the request has an If-None-Match header that
+    matches, return 304 Not Modified with no body.
+
+    If peer_id is given, remember that peer has pulled up to
+    start_sequence_id, so tombstones are kept until it has them.
+    Return 410 Gone if tombstones it hasn't seen were already purged,
+    so it needs a full resync.
+
+    If where is given, it is a JSON object of column values, and only docs
+    with them are returned (see Datastore.get_docs_since).
+
+    If deltas is true, return patches with only the changed columns where
+    the model has a `_delta` column (see Datastore.get_deltas_since).
     """
-    table = SyncableModel.get_table_by_class_name(object_name)
-    if not table:
-        raise HttpError(403, f"Unknown table '{object_name}'")
+    table = _get_table(object_name)
+    the_where = _get_where(where)
+    if peer_id:
+        _ack_peer(datastore, table, peer_id, start_sequence_id)
+    etag = _docs_etag(datastore, start_sequence_id, chunk_size, the_where, deltas)
+    if util.etag_matches(request.headers.get("If-None-Match"), etag):
+        not_modified = HttpResponse(status=304)
+        not_modified["ETag"] = etag
+        return not_modified
     with _get_datastore(datastore, table) as datastore1:
-        seq_id, docs = datastore1.get_docs_since(start_sequence_id, chunk_size)
+        get_docs_since = (
+            datastore1.get_deltas_since if deltas else datastore1.get_docs_since
+        )
+        try:
+            seq_id, docs = get_docs_since(start_sequence_id, chunk_size, the_where)
+        except ValueError as err:
+            raise HttpError(422, str(err))
+        response["ETag"] = util.docs_etag(
+            datastore1.id, seq_id, start_sequence_id, chunk_size, the_where, deltas
+        )
         return {"current_sequence_id": seq_id, "documents": docs}
 
 
+@api.get("{datastore}/{object_name}/snapshot")
+# pylint: disable-next=too-many-positional-arguments
+def get_snapshot(
+    request,
+    datastore: str,
+    object_name: str,
+    chunk_size: int = 1000,
+    peer_id: str = None,
+    where: str = None,
+):
+    """GET a gzipped snapshot of all docs, to bootstrap a new client.
+
+    See Datastore.write_snapshot.  The X-Sequence-Id header has the sequence
+    id to pull docs from afterwards.  If peer_id is given, keep tombstones
+    from that sequence id on for the peer, and if where is given, only have
+    docs with those values, as get_docs does.
+    """
+    table = _get_table(object_name)
+    the_where = _get_where(where)
+    snapshot_file = tempfile.SpooledTemporaryFile(max_size=SNAPSHOT_MAX_MEMORY)
+    with _get_datastore(datastore, table) as datastore1:
+        try:
+            seq = datastore1.write_snapshot(snapshot_file, chunk_size, the_where)
+        except ValueError as err:
+            raise HttpError(422, str(err))
+        if peer_id:
+            datastore1.ack_peer_sequence_id(peer_id, seq)
+    snapshot_file.seek(0)
+    response = FileResponse(snapshot_file, content_type="application/gzip")
+    response["X-Sequence-Id"] = str(seq)
+    return response
+
+
 @api.post("{datastore}/{object_name}/docs", response=dict)
-def put_docs(request, datastore: str, object_name: str, increment_rev: bool = False):
+# pylint: disable-next=too-many-positional-arguments
+def put_docs(
+    request,
+    datastore: str,
+    object_name: str,
+    increment_rev: bool = False,
+    deltas: bool = False,
+):
     """Put doc in given array of docs if rev is greater or doc doesn't exist.
 
     Return `{"num_docs_put": num_put, "documents": new_docs}`
+
+    If deltas is true, the docs may be patches from get_deltas_since.
+    Return `{"num_docs_put": num_put, "missing_seqs": missing_seqs}`, where
+    missing_seqs are the `_seq` of patches of versions we don't have.
     """
-    table = SyncableModel.get_table_by_class_name(object_name)
-    if not table:
-        raise HttpError(403, f"Unknown table '{object_name}'")
+    table = _get_table(object_name)
     with _get_datastore(datastore, table) as datastore1:
+        if deltas:
+            try:
+                num_put, missing_seqs = datastore1.put_deltas(
+                    [Document(the_doc) for the_doc in _get_json_body(request)]
+                )
+            except ValueError as err:
+                raise HttpError(422, str(err))
+            finally:
+                SyncableModel.notify_sequence_id(datastore, datastore1.sequence_id)
+            return {"num_docs_put": num_put, "missing_seqs": missing_seqs}
         num_put = 0
         new_docs = []
         try:
@@ -131,5 +277,156 @@ def put_docs(request, datastore: str, object_name: str, increment_rev: bool = Fa
                     new_docs.append(new_doc)
         except ValueError as err:
             raise HttpError(422, str(err))
+        finally:
+            SyncableModel.notify_sequence_id(datastore, datastore1.sequence_id)
         # TODO: should response have docs with clocks set?  I think yes.
         return {"num_docs_put": num_put, "documents": new_docs}
+
+
+def _get_multi_datastore(datastore_name: str) -> MultiTableDatastore:
+    """Return all tables of a datastore as one, with docs tagged by their
+    SyncableModel class name."""
+    infos = registry.get_by_datastore_name(datastore_name)
+    if not infos:
+        raise HttpError(404, f"Datastore {datastore_name} not found")
+    return MultiTableDatastore(
+        {
+            info.class_name: _get_datastore(datastore_name, info.db_table)
+            for info in infos
+        }
+    )
+
+
+@api.get("{datastore}/docs", response=dict)
+# pylint: disable-next=too-many-positional-arguments
+def get_all_docs(
+    request,
+    response: HttpResponse,
+    datastore: str,
+    start_sequence_id: int,
+    chunk_size: int = 100,
+    peer_id: str = None,
+    where: str = None,
+):
+    """GET docs of all tables in one stream, like get_docs.
+
+    Each doc has its SyncableModel class name in `_table`.  where is a JSON
+    object of each class name's column values.
+    """
+    the_where = _get_where(where)
+    with _get_multi_datastore(datastore) as datastore1:
+        if peer_id:
+            try:
+                datastore1.check_peer_sequence_id(start_sequence_id)
+            except ResyncRequired as err:
+                raise HttpError(410, str(err))
+            datastore1.ack_peer_sequence_id(peer_id, start_sequence_id)
+        etag = util.docs_etag(
+            datastore1.id,
+            datastore1.sequence_id,
+            start_sequence_id,
+            chunk_size,
+            the_where,
+        )
+        if util.etag_matches(request.headers.get("If-None-Match"), etag):
+            not_modified = HttpResponse(status=304)
+            not_modified["ETag"] = etag
+            return not_modified
+        try:
+            seq_id, docs = datastore1.get_docs_since(
+                start_sequence_id, chunk_size, the_where
+            )
+        except ValueError as err:
+            raise HttpError(422, str(err))
+        response["ETag"] = util.docs_etag(
+            datastore1.id, seq_id, start_sequence_id, chunk_size, the_where
+        )
+        return {"current_sequence_id": seq_id, "documents": docs}
+
+
+@api.post("{datastore}/docs", response=dict)
+def put_all_docs(request, datastore: str, increment_rev: bool = False):
+    """Put docs of any tables, like put_docs.
+
+    Each doc must have its SyncableModel class name in `_table`.
+    """
+    with _get_multi_datastore(datastore) as datastore1:
+        num_put = 0
+        new_docs = []
+        try:
+            for the_doc in _get_json_body(request):
+                num, new_doc = datastore1.put(
+                    Document(the_doc), increment_rev=increment_rev
+                )
+                num_put += num
+                if num:
+                    new_docs.append(new_doc)
+        except ValueError as err:
+            raise HttpError(422, str(err))
+        finally:
+            SyncableModel.notify_sequence_id(datastore, datastore1.sequence_id)
+        return {"num_docs_put": num_put, "documents": new_docs}
+
+
+def _current_sequence_id(datastore_name: str) -> int:
+    """Return the sequence id of a datastore, or 0 if it doesn't exist yet."""
+    row = SyncableModel.read_sequence_id(datastore_name)
+    return row[1] if row else 0
+
+
+@api.get("{datastore}/{object_name}/changes", response=dict)
+def get_changes(
+    request,
+    datastore: str,
+    object_name: str,
+    start_sequence_id: int,
+    timeout: float = 30,
+):
+    """Wait until the datastore's sequence id is > start_sequence_id, or timeout.
+
+    timeout is in seconds, and at most CHANGES_MAX_TIMEOUT.
+
+    Return `{"current_sequence_id": cur_seq_id}`, where cur_seq_id is
+    <= start_sequence_id if nothing changed.
+    """
+    # check the table exists
+    _get_table(object_name)
+    seq = notifier.wait(
+        datastore,
+        start_sequence_id,
+        min(timeout, CHANGES_MAX_TIMEOUT),
+        get_sequence_id=lambda: _current_sequence_id(datastore),
+        poll_interval=CHANGES_POLL_INTERVAL,
+    )
+    return {"current_sequence_id": seq}
+
+
+@api.get("{datastore}/{object_name}/changes/stream")
+def stream_changes(
+    request,
+    datastore: str,
+    object_name: str,
+    start_sequence_id: int = 0,
+    timeout: float = 300,
+):
+    """Stream server-sent events as the datastore's sequence id moves.
+
+    Each event has data `{"current_sequence_id": cur_seq_id}`.
+    The stream ends after timeout seconds, and the client reconnects.
+    A Last-Event-ID header overrides start_sequence_id.
+    """
+    # check the table exists
+    _get_table(object_name)
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id:
+        start_sequence_id = int(last_event_id)
+    events = notifier.stream(
+        datastore,
+        start_sequence_id,
+        timeout,
+        get_sequence_id=lambda: _current_sequence_id(datastore),
+        poll_interval=CHANGES_POLL_INTERVAL,
+    )
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response
@@ -1,6 +1,26 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+from reldatasync_app.registry import registry
+
+
+def _clear_metadata_cache(**kwargs):
+    """The schema may have changed, so forget cached table metadata."""
+    # pylint: disable-next=import-outside-toplevel
+    from reldatasync_app.models import metadata_cache
+
+    metadata_cache.clear()
 
 
 class ReldatasyncAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "reldatasync_app"
+
+    def ready(self):
+        # pylint: disable-next=import-outside-toplevel
+        from reldatasync_app.models import SyncableModel
+
+        # All models are loaded by now, including other apps' SyncableModels
+        registry.populate(SyncableModel)
+
+        # No sender: a migration of any app can change a syncable table
+        post_migrate.connect(_clear_metadata_cache)
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from reldatasync_app.models import SyncableModel
+from reldatasync_app.registry import registry
+
+
+class Command(BaseCommand):
+    help = (
+        "Physically delete tombstones (deleted rows) that every peer of a"
+        " datastore has already pulled."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("datastore", help="Datastore name")
+        parser.add_argument(
+            "--forget-peer",
+            action="append",
+            default=[],
+            help="Stop keeping tombstones for this peer id (which will need a"
+            " full resync if it syncs again).  May be repeated.",
+        )
+        parser.add_argument(
+            "--list-peers",
+            action="store_true",
+            help="Print peers and how far they have pulled, and don't purge",
+        )
+
+    def handle(self, *args, **options):
+        datastore_name = options["datastore"]
+        infos = registry.get_by_datastore_name(datastore_name)
+        if not infos:
+            raise CommandError(f"No SyncableModels in datastore {datastore_name}")
+
+        # Peers and sequence ids are per datastore, shared by its tables
+        with transaction.atomic():
+            for info in infos:
+                with SyncableModel.get_datastore_by_name(
+                    datastore_name, info.db_table
+                ) as ds:
+                    for peer in options["forget_peer"]:
+                        ds.forget_peer(peer)
+                    if options["list_peers"]:
+                        for peer, seq in sorted(ds.get_peer_acks().items()):
+                            self.stdout.write(f"{peer} {seq}")
+                        self.stdout.write(
+                            f"horizon {ds.gc_horizon()}"
+                            f" purged {ds.get_purged_sequence_id()}"
+                        )
+                        return
+                    num = ds.purge_tombstones()
+                    self.stdout.write(
+                        f"{info.class_name}: purged {num} tombstones"
+                        f" up to sequence id {ds.get_purged_sequence_id()}"
+                    )
@@ -4,9 +4,10 @@ from urllib import parse
 from urllib.parse import urlparse
 
 import psycopg2
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from reldatasync.datastore import Datastore, PostgresDatastore, SqliteDatastore
-from reldatasync.replicator import Replicator
+from reldatasync.replicator import ReplicationError, Replicator
+from reldatasync_app.registry import registry
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +35,10 @@ def get_datastore(ds_url: str) -> Datastore:
         pathcomps = dbc.path.lstrip("/").split("/")
         # print(f'pathcomps {str(pathcomps)}')
         dbname, tablename = pathcomps
+        # The table can also be named by its SyncableModel class
+        info = registry.get_by_class_name(tablename)
+        if info:
+            tablename = info.db_table
 
         if dbc.scheme == "postgresql":
             # dbname/tablename?datastore=datastorename
@@ -73,7 +78,11 @@ class Command(BaseCommand):
         ds2 = get_datastore(ds2_url)
 
         with ds1, ds2:
-            Replicator(ds1, ds2).sync_both_directions()
+            # Commit each chunk with how far it got
+            try:
+                Replicator(ds1, ds2, chunk_transactions=True).sync_both_directions()
+            except ReplicationError as err:
+                raise CommandError(str(err)) from err
             ds1.check()
             ds2.check()
             print(f"ds1 seq: {ds1.sequence_id}, ds2 seq: {ds2.sequence_id}")
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("reldatasync_app", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="datasyncrevisions",
+            name="purged_sequence_id",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name="DataSyncPeers",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("datastore_id", models.CharField(max_length=100)),
+                ("peer_id", models.CharField(max_length=100)),
+                ("sequence_id", models.IntegerField()),
+            ],
+            options={
+                "db_table": "data_sync_peers",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("datastore_id", "peer_id"),
+                        name="data_sync_peers_unique",
+                    )
+                ],
+            },
+        ),
+    ]
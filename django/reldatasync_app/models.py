@@ -1,6 +1,16 @@
-from django.db import connections, models
-from reldatasync.datastore import PostgresDatastore
-from reldatasync.util import all_subclasses, uuid4_string
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections, models, transaction
+from reldatasync.changefeed import notifier
+from reldatasync.datastore import PostgresDatastore, TableMetadataCache
+from reldatasync.util import uuid4_string
+from reldatasync_app.registry import registry
+
+# Table metadata for datastores in this process,
+# keyed by (connection alias, datastore name, table).
+# Cleared after migrations, see ReldatasyncAppConfig.
+metadata_cache = TableMetadataCache()
 
 
 class DataSyncRevisions(models.Model):
@@ -10,14 +20,143 @@ class DataSyncRevisions(models.Model):
     datastore_id = models.CharField(unique=True, primary_key=True, max_length=100)
     datastore_name = models.CharField(max_length=100, unique=True)
     sequence_id = models.IntegerField()
+    # Tombstones with _seq <= this may have been purged
+    purged_sequence_id = models.IntegerField(null=True, blank=True)
 
     class Meta:
         db_table = "data_sync_revisions"
 
 
+class DataSyncPeers(models.Model):
+    """How far each peer has pulled from a datastore, to purge tombstones."""
+
+    datastore_id = models.CharField(max_length=100)
+    peer_id = models.CharField(max_length=100)
+    sequence_id = models.IntegerField()
+
+    class Meta:
+        db_table = "data_sync_peers"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datastore_id", "peer_id"], name="data_sync_peers_unique"
+            )
+        ]
+
+
+class DataSyncPeerSeqs(models.Model):
+    """How far a datastore has pulled from each peer."""
+
+    datastore_id = models.CharField(max_length=100)
+    peer_id = models.CharField(max_length=100)
+    sequence_id = models.IntegerField()
+
+    class Meta:
+        db_table = "data_sync_peer_seqs"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datastore_id", "peer_id"], name="data_sync_peer_seqs_unique"
+            )
+        ]
+
+
+class SyncableQuerySet(models.QuerySet):
+    """QuerySet whose bulk writes set _rev, _seq, and _deleted properly.
+
+    Each bulk write reserves its seqs with one datastore update, instead of
+    one per object as in save().
+    """
+
+    # Rows per UPDATE when deleting
+    TOMBSTONE_BATCH_SIZE = 1000
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        # Commit the seqs with the rows, as in SyncableModel.save()
+        with transaction.atomic(using=self.db):
+            self.model._assign_revs_and_seqs(objs, deleted=False)
+            ret = super().bulk_create(objs, *args, **kwargs)
+        self.model._notify_objs(objs)
+        return ret
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        fields = list(fields)
+        fields += [
+            field for field in ("_rev", "_seq", "_deleted") if field not in fields
+        ]
+        with transaction.atomic(using=self.db):
+            self.model._assign_revs_and_seqs(objs, deleted=False)
+            ret = super().bulk_update(objs, fields, *args, **kwargs)
+        self.model._notify_objs(objs)
+        return ret
+
+    def delete(self):
+        """Instead of removing the rows, update them with _deleted True.
+
+        Rows already deleted are left alone.  The others get new revs and seqs,
+        as with delete() of each object, but in a few set-based UPDATEs.
+
+        Return (number of rows deleted, {model label: number}), as Django does.
+        """
+        if self.query.is_sliced:
+            raise TypeError("Cannot use 'limit' or 'offset' with delete().")
+        with transaction.atomic(using=self.db):
+            rows = self.exclude(_deleted=True).order_by("pk").values_list("pk", "_rev")
+            objs = [self.model(pk=pk, _rev=rev) for pk, rev in rows]
+            self.model._assign_revs_and_seqs(objs, deleted=True)
+            with connections[self.db].cursor() as cursor:
+                for start in range(0, len(objs), self.TOMBSTONE_BATCH_SIZE):
+                    batch = objs[start : start + self.TOMBSTONE_BATCH_SIZE]
+                    cursor.execute(*self._tombstone_sql(batch))
+        self.model._notify_objs(objs)
+        return len(objs), {self.model._meta.label: len(objs)}
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def _tombstone_sql(self, objs) -> tuple[str, list]:
+        """Return SQL and params to set _deleted, _rev, and _seq of objs.
+
+        This is what bulk_update() does, without the cost of building
+        Django expressions for every object.
+        """
+        quote_name = connections[self.db].ops.quote_name
+        table = quote_name(self.model._meta.db_table)
+        pk_col = quote_name(self.model._meta.pk.column)
+        whens = " ".join(["WHEN %s THEN %s"] * len(objs))
+        pks = ", ".join(["%s"] * len(objs))
+        sql = (
+            f"UPDATE {table} SET _deleted = %s,"
+            f" _rev = CASE {pk_col} {whens} END,"
+            f" _seq = CASE {pk_col} {whens} END"
+            f" WHERE {pk_col} IN ({pks})"
+        )
+        params = [True]
+        for obj in objs:
+            params += [obj.pk, obj._rev]
+        for obj in objs:
+            params += [obj.pk, obj._seq]
+        params += [obj.pk for obj in objs]
+        return sql, params
+
+    soft_delete = delete
+
+    def hard_delete(self):
+        """Really remove the rows, with Django's QuerySet.delete().
+
+        Peers never hear about rows removed this way.
+        """
+        return super().delete()
+
+    hard_delete.alters_data = True
+    hard_delete.queryset_only = True
+
+
 class SyncableModel(models.Model):
     REV_LENGTH = 2000
 
+    objects = SyncableQuerySet.as_manager()
+
     # fields needed for PostgresDatastore: _id, _rev, _deleted
     _id = models.CharField(
         unique=True,
@@ -36,35 +175,64 @@ class SyncableModel(models.Model):
     @staticmethod
     def _get_class_by_name(name: str) -> type["SyncableModel"] | None:
         """Return a subclass of SyncableModel with given name, or none."""
-        for cls in all_subclasses(SyncableModel):
-            if cls.__name__ == name:
-                return cls
-        return None
+        info = registry.get_by_class_name(name)
+        return info.model if info else None
 
     @staticmethod
     def get_table_by_class_name(name: str) -> str | None:
-        result = None
-        cls = SyncableModel._get_class_by_name(name)
-        if cls:
-            result = cls._meta.db_table
-        return result
+        info = registry.get_by_class_name(name)
+        return info.db_table if info else None
 
     @staticmethod
     def get_datastore_by_name(datastore_name, db_table, conn=None) -> PostgresDatastore:
-        """Get Datastore given its name and db_table."""
+        """Get Datastore given its name and db_table.
+
+        The datastore is cheap to make: entering it reads the datastore id and
+        sequence id in one query, and gets table metadata from metadata_cache.
+        """
         if not conn:
             conn = connections["default"]
 
-        # get id for name if it exists
-        ds_id = None
-        try:
-            row = DataSyncRevisions.objects.get(datastore_name=datastore_name)
-            ds_id = row.datastore_id
-        except DataSyncRevisions.DoesNotExist:
-            # that's okay
-            pass
+        # No need to look up the datastore id: entering the datastore reads it,
+        # or saves a new one if there is none.
+        return PostgresDatastore(
+            datastore_name,
+            conn,
+            db_table,
+            metadata_cache=metadata_cache,
+            cache_key=(conn.alias, datastore_name, db_table),
+            track_peers=True,
+            use_sequence=SyncableModel.use_sequence(conn),
+        )
+
+    @staticmethod
+    def use_sequence(conn) -> bool:
+        """Whether datastores allocate seqs from a Postgres SEQUENCE.
 
-        return PostgresDatastore(datastore_name, conn, db_table, datastore_id=ds_id)
+        Set RELDATASYNC_USE_SEQUENCES = True in settings to turn it on, so
+        concurrent writers don't wait on each other.  See PostgresDatastore.
+        """
+        return conn.vendor == "postgresql" and getattr(
+            settings, "RELDATASYNC_USE_SEQUENCES", False
+        )
+
+    @staticmethod
+    def read_sequence_id(datastore_name: str, conn=None) -> Optional[tuple[str, int]]:
+        """Return (datastore id, sequence id), or None if there's no datastore.
+
+        This is one query (three with sequences), without a datastore.
+        """
+        if not conn:
+            conn = connections["default"]
+        with conn.cursor() as cursor:
+            return PostgresDatastore.read_sequence_id(
+                cursor, datastore_name, SyncableModel.use_sequence(conn)
+            )
+
+    @staticmethod
+    def notify_sequence_id(datastore_name: str, sequence_id: int) -> None:
+        """Wake up change feed waiters once the current transaction commits."""
+        transaction.on_commit(lambda: notifier.notify(datastore_name, sequence_id))
 
     @classmethod
     def _get_datastore(cls, conn=None):
@@ -82,20 +250,47 @@ class SyncableModel(models.Model):
                     f"_rev is limited to {SyncableModel.REV_LENGTH} characters"
                 )
 
+    @classmethod
+    def _assign_revs_and_seqs(cls, objs, deleted: bool):
+        """Assign _rev, _seq, and _deleted of objs, with one range of seqs."""
+        if not objs:
+            return
+        with cls._get_datastore() as pd:
+            revs_and_seqs = pd.new_revs_and_seqs([obj._rev for obj in objs])
+        for obj, (rev, seq) in zip(objs, revs_and_seqs):
+            if len(rev) > SyncableModel.REV_LENGTH:
+                raise ValueError(
+                    f"_rev is limited to {SyncableModel.REV_LENGTH} characters"
+                )
+            obj._rev, obj._seq, obj._deleted = rev, seq, deleted
+
+    @classmethod
+    def _notify_objs(cls, objs):
+        if objs:
+            cls.notify_sequence_id(
+                cls.DatastoreMeta.datastore_name, max(obj._seq for obj in objs)
+            )
+
     def save(self, *args, **kwargs):
         """save() that sets _rev, _seq, and _deleted properly"""
-        self._assign_rev_and_seq()
-        self._deleted = False
-        super().save(*args, **kwargs)
+        # Commit the seq with the row, so no one sees the sequence id pass
+        # a row that isn't there yet
+        with transaction.atomic():
+            self._assign_rev_and_seq()
+            self._deleted = False
+            super().save(*args, **kwargs)
+        self.notify_sequence_id(self.DatastoreMeta.datastore_name, self._seq)
 
     def delete(self, *args, **kwargs):
         """Instead of removing the row, update it with _deleted True"""
-        # Set _REV, _SEQ, _DELETED properly
-        self._assign_rev_and_seq()
-        self._deleted = True
-        # Don't call super().delete(), since we want to keep the row
-        # Do call super().save() to save the "tombstone"
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            # Set _REV, _SEQ, _DELETED properly
+            self._assign_rev_and_seq()
+            self._deleted = True
+            # Don't call super().delete(), since we want to keep the row
+            # Do call super().save() to save the "tombstone"
+            super().save(*args, **kwargs)
+        self.notify_sequence_id(self.DatastoreMeta.datastore_name, self._seq)
 
     class Meta:
         # See https://docs.djangoproject.com/en/4.0/topics/db/models/#abstract-base-classes  # noqa
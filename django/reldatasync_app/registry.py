@@ -0,0 +1,87 @@
+"""A registry of SyncableModel subclasses, so looking one up is a dict lookup."""
+
+from typing import Optional
+
+from reldatasync.schema import Schema
+from reldatasync.util import all_subclasses
+
+# Django internal field type -> reldatasync schema type
+# See https://docs.djangoproject.com/en/5.0/ref/models/fields/#field-types
+_FIELD_TYPES = {
+    "AutoField": "INTEGER",
+    "BigAutoField": "INTEGER",
+    "BigIntegerField": "INTEGER",
+    "IntegerField": "INTEGER",
+    "PositiveBigIntegerField": "INTEGER",
+    "PositiveIntegerField": "INTEGER",
+    "PositiveSmallIntegerField": "INTEGER",
+    "SmallAutoField": "INTEGER",
+    "SmallIntegerField": "INTEGER",
+    "DecimalField": "REAL",
+    "FloatField": "REAL",
+    "BooleanField": "BOOLEAN",
+    "NullBooleanField": "BOOLEAN",
+    "DateField": "DATE",
+    "DateTimeField": "DATETIME",
+}
+
+
+def _field_type(field) -> str:
+    """Return the schema type of a concrete model field."""
+    if field.is_relation:
+        # A foreign key column has the type of the field it points to
+        field = field.target_field
+    return _FIELD_TYPES.get(field.get_internal_type(), "TEXT")
+
+
+class SyncableModelInfo:
+    """What we need to know about a SyncableModel subclass to sync it."""
+
+    def __init__(self, model):
+        self.model = model
+        self.class_name = model.__name__
+        self.db_table = model._meta.db_table
+        self.datastore_name = model.DatastoreMeta.datastore_name
+        fields = model._meta.concrete_fields
+        self.columns = [field.column for field in fields]
+        self.schema = Schema({field.column: _field_type(field) for field in fields})
+
+
+class SyncableModelRegistry:
+    def __init__(self):
+        self._by_class_name = {}
+        self._by_table = {}
+
+    def register(self, model) -> SyncableModelInfo:
+        info = SyncableModelInfo(model)
+        self._by_class_name[info.class_name] = info
+        self._by_table[info.db_table] = info
+        return info
+
+    def populate(self, base_class) -> None:
+        """Register every concrete subclass of base_class.
+
+        Call this once all models are loaded, e.g. in AppConfig.ready().
+        """
+        self._by_class_name.clear()
+        self._by_table.clear()
+        for cls in all_subclasses(base_class):
+            if not cls._meta.abstract:
+                self.register(cls)
+
+    def get_by_class_name(self, name: str) -> Optional[SyncableModelInfo]:
+        return self._by_class_name.get(name, None)
+
+    def get_by_table(self, db_table: str) -> Optional[SyncableModelInfo]:
+        return self._by_table.get(db_table, None)
+
+    def get_by_datastore_name(self, datastore_name: str) -> list[SyncableModelInfo]:
+        return [
+            info
+            for info in self._by_table.values()
+            if info.datastore_name == datastore_name
+        ]
+
+
+# Populated by ReldatasyncAppConfig.ready()
+registry = SyncableModelRegistry()
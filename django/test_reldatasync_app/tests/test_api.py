@@ -1,8 +1,12 @@
+import datetime
 import json
+from io import BytesIO, StringIO
 
+from django.core.management import call_command
 from django.test import Client, TransactionTestCase
 from django.urls import reverse
-from test_reldatasync_app.models import DATASTORE_NAME, Organization
+from reldatasync.datastore import MemoryDatastore
+from test_reldatasync_app.models import DATASTORE_NAME, Organization, Patient
 
 
 class ApiTest(TransactionTestCase):
@@ -178,6 +182,202 @@ class ApiTest(TransactionTestCase):
         self.assertEqual(2, data["documents"][0]["_seq"])
         self.assertEqual(name2, data["documents"][0]["name"])
 
+    def test_get_docs_where(self):
+        org1 = Organization(name="org1")
+        org1.save()
+        org2 = Organization(name="org2")
+        org2.save()
+        for org in [org1, org2, org1]:
+            Patient(
+                name=f"pat of {org.name}",
+                residence="here",
+                age=30,
+                birth_date=datetime.date(1990, 1, 1),
+                email="pat@example.com",
+                org=org,
+            ).save()
+
+        # A device of org1 only gets org1's patients
+        client = Client()
+        the_url = reverse("api-1.0.0:get_docs", args=[DATASTORE_NAME, "Patient"])
+        where = json.dumps({"org_id": org1._id})
+        response = client.get(the_url, data={"start_sequence_id": 0, "where": where})
+        self.assertEqual(200, response.status_code, response.content)
+        data = json.loads(response.content)
+        self.assertEqual(5, data["current_sequence_id"])
+        self.assertEqual([3, 5], [doc["_seq"] for doc in data["documents"]])
+        # Other filters have other ETags
+        response2 = client.get(the_url, data={"start_sequence_id": 0})
+        self.assertNotEqual(response["ETag"], response2["ETag"])
+
+        # Only columns of the table
+        for where in ['{"oops": 1}', "[1]", "oops"]:
+            response = client.get(
+                the_url, data={"start_sequence_id": 0, "where": where}
+            )
+            self.assertEqual(422, response.status_code, response.content)
+
+    def test_get_docs_etag(self):
+        client = Client()
+        the_url = reverse("api-1.0.0:get_docs", args=[DATASTORE_NAME, "Organization"])
+        org1 = Organization(name="name1")
+        org1.save()
+
+        response = client.get(the_url, data={"start_sequence_id": 0})
+        self.assertEqual(200, response.status_code, response.content)
+        etag = response["ETag"]
+        self.assertTrue(etag)
+
+        # Nothing changed, so 304 with no body
+        response = client.get(
+            the_url, data={"start_sequence_id": 0}, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(304, response.status_code, response.content)
+        self.assertEqual(etag, response["ETag"])
+        self.assertEqual(b"", response.content)
+
+        # A different chunk has a different ETag
+        response = client.get(
+            the_url, data={"start_sequence_id": 1}, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertNotEqual(etag, response["ETag"])
+
+        # After a change, the old ETag no longer matches
+        org2 = Organization(name="name2")
+        org2.save()
+        response = client.get(
+            the_url, data={"start_sequence_id": 0}, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertNotEqual(etag, response["ETag"])
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(2, len(data["documents"]))
+
+    def test_get_docs_peer_id(self):
+        client = Client()
+        the_url = reverse("api-1.0.0:get_docs", args=[DATASTORE_NAME, "Organization"])
+        org1 = Organization(name="name1")
+        org1.save()
+        Organization(name="name2").save()
+        org1.delete()
+
+        # peer1 has pulled everything, peer2 only the first doc
+        for peer_id, seq in (("peer1", 3), ("peer2", 1)):
+            response = client.get(
+                the_url, data={"start_sequence_id": seq, "peer_id": peer_id}
+            )
+            self.assertEqual(200, response.status_code, response.content)
+        out = StringIO()
+        call_command("purge_tombstones", DATASTORE_NAME, list_peers=True, stdout=out)
+        self.assertEqual("peer1 3\npeer2 1\nhorizon 1 purged 0\n", out.getvalue())
+
+        # peer2 hasn't seen the tombstone, so it stays
+        call_command("purge_tombstones", DATASTORE_NAME, stdout=StringIO())
+        self.assertTrue(Organization.objects.filter(_id=org1._id).exists())
+
+        # Forget peer2, and the tombstone goes
+        out = StringIO()
+        call_command(
+            "purge_tombstones", DATASTORE_NAME, forget_peer=["peer2"], stdout=out
+        )
+        self.assertIn(
+            "Organization: purged 1 tombstones up to sequence id 3", out.getvalue()
+        )
+        self.assertFalse(Organization.objects.filter(_id=org1._id).exists())
+
+        # peer2 missed it, so it must resync, and peer1 is fine
+        response = client.get(
+            the_url, data={"start_sequence_id": 1, "peer_id": "peer2"}
+        )
+        self.assertEqual(410, response.status_code, response.content)
+        response = client.get(
+            the_url, data={"start_sequence_id": 3, "peer_id": "peer1"}
+        )
+        self.assertEqual(200, response.status_code, response.content)
+
+    def test_get_snapshot(self):
+        org1 = Organization(name="name1")
+        org1.save()
+        Organization(name="name2").save()
+        org1.delete()
+
+        client = Client()
+        response = client.get(
+            reverse("api-1.0.0:get_snapshot", args=[DATASTORE_NAME, "Organization"]),
+            data={"peer_id": "peer1"},
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("3", response["X-Sequence-Id"])
+        snapshot = BytesIO(b"".join(response.streaming_content))
+
+        # It loads into a new datastore, with the tombstone
+        ds = MemoryDatastore("new")
+        self.assertEqual((3, 2), ds.load_snapshot(snapshot))
+        self.assertTrue(ds.get(org1._id, include_deleted=True)["_deleted"])
+
+        # The peer is registered at the snapshot's sequence id
+        out = StringIO()
+        call_command("purge_tombstones", DATASTORE_NAME, list_peers=True, stdout=out)
+        self.assertIn("peer1 3\n", out.getvalue())
+
+    def test_all_docs(self):
+        org = Organization(name="org")
+        org.save()
+        Patient(
+            name="pat",
+            residence="here",
+            age=30,
+            birth_date=datetime.date(1990, 1, 1),
+            email="pat@example.com",
+            org=org,
+        ).save()
+
+        # Docs of both tables come in one stream, in seq order
+        client = Client()
+        the_url = reverse("api-1.0.0:get_all_docs", args=[DATASTORE_NAME])
+        response = client.get(the_url, data={"start_sequence_id": 0})
+        self.assertEqual(200, response.status_code, response.content)
+        data = json.loads(response.content)
+        self.assertEqual(2, data["current_sequence_id"])
+        self.assertEqual(
+            [(1, "Organization"), (2, "Patient")],
+            [(doc["_seq"], doc["_table"]) for doc in data["documents"]],
+        )
+
+        # Put docs of both tables in one request
+        docs = data["documents"]
+        docs[0]["name"] = "org2"
+        docs[1]["name"] = "pat2"
+        for doc in docs:
+            # A later rev, from another peer
+            doc["_rev"] = json.dumps({**json.loads(doc["_rev"]), "other": 1})
+        response = client.post(
+            reverse("api-1.0.0:put_all_docs", args=[DATASTORE_NAME]),
+            data=docs,
+            content_type="application/json",
+        )
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(2, json.loads(response.content)["num_docs_put"])
+        self.assertEqual("org2", Organization.objects.get(_id=org._id).name)
+        self.assertEqual("pat2", Patient.objects.get().name)
+
+        # A doc must say what table it is in
+        del docs[0]["_table"]
+        response = client.post(
+            reverse("api-1.0.0:put_all_docs", args=[DATASTORE_NAME]),
+            data=docs,
+            content_type="application/json",
+        )
+        self.assertEqual(422, response.status_code, response.content)
+
+        # Unknown datastore
+        response = client.get(
+            reverse("api-1.0.0:get_all_docs", args=["oops"]),
+            data={"start_sequence_id": 0},
+        )
+        self.assertEqual(404, response.status_code, response.content)
+
     def test_put_docs(self):
         client = Client()
         the_url = reverse("api-1.0.0:put_docs", args=[DATASTORE_NAME, "Organization"])
@@ -212,3 +412,60 @@ class ApiTest(TransactionTestCase):
         data = json.loads(response.content.decode("utf-8"))
         self.assertEqual(0, data["num_docs_put"])
         self.assertEqual(0, len(data["documents"]))
+
+    def test_get_changes(self):
+        client = Client()
+        the_url = reverse(
+            "api-1.0.0:get_changes", args=[DATASTORE_NAME, "Organization"]
+        )
+
+        # no datastore yet, so nothing changed
+        response = client.get(the_url, data={"start_sequence_id": 0, "timeout": 0})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual({"current_sequence_id": 0}, json.loads(response.content))
+
+        org = Organization(name="org")
+        org.save()
+
+        # already past the watermark, so return right away
+        response = client.get(the_url, data={"start_sequence_id": 0, "timeout": 30})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual({"current_sequence_id": 1}, json.loads(response.content))
+
+        # nothing new, so time out
+        response = client.get(the_url, data={"start_sequence_id": 1, "timeout": 0.1})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual({"current_sequence_id": 1}, json.loads(response.content))
+
+        # Unknown table
+        the_url = reverse("api-1.0.0:get_changes", args=[DATASTORE_NAME, "oops"])
+        response = client.get(the_url, data={"start_sequence_id": 0})
+        self.assertEqual(403, response.status_code, response.content)
+
+    def test_stream_changes(self):
+        org = Organization(name="org")
+        org.save()
+
+        client = Client()
+        the_url = reverse(
+            "api-1.0.0:stream_changes", args=[DATASTORE_NAME, "Organization"]
+        )
+        response = client.get(the_url, data={"start_sequence_id": 0, "timeout": 0.1})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("text/event-stream", response["Content-Type"])
+        events = b"".join(response.streaming_content).decode("utf-8")
+        self.assertTrue(
+            events.startswith(
+                'id: 1\nevent: sequence_id\ndata: {"current_sequence_id": 1}\n\n'
+            ),
+            events,
+        )
+
+        # Last-Event-ID says the client already has 1, so nothing new
+        response = client.get(
+            the_url,
+            data={"start_sequence_id": 0, "timeout": 0.1},
+            headers={"Last-Event-ID": "1"},
+        )
+        events = b"".join(response.streaming_content).decode("utf-8")
+        self.assertNotIn("data:", events)
@@ -0,0 +1,195 @@
+import os
+import time
+from datetime import date
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from reldatasync.vectorclock import VectorClock
+from reldatasync_app.models import SyncableModel
+from test_reldatasync_app.models import Organization, Patient
+
+# Number of patients for the benchmark, which only runs if this is set
+BENCHMARK_NUM = int(os.getenv("RDS_BENCHMARK_NUM", "0"))
+
+
+def _patients(org, num):
+    return [
+        Patient(
+            name=f"patient{idx}",
+            residence="residence",
+            age=idx % 100,
+            birth_date=date(2000, 1, 1),
+            email=f"patient{idx}@example.com",
+            org=org,
+        )
+        for idx in range(num)
+    ]
+
+
+class BulkTest(TransactionTestCase):
+    def setUp(self):
+        self.org = Organization(name="org")
+        self.org.save()
+
+    def test_bulk_create(self):
+        pats = _patients(self.org, 5)
+        Patient.objects.bulk_create(pats)
+
+        # the org has seq 1, so the patients have 2..6
+        self.assertEqual(
+            list(range(2, 7)),
+            list(Patient.objects.order_by("_seq").values_list("_seq", flat=True)),
+        )
+        for pat in Patient.objects.all():
+            self.assertGreater(VectorClock.from_string(pat._rev), VectorClock({}))
+            self.assertFalse(pat._deleted)
+
+        # save() continues after the reserved seqs
+        pat = Patient.objects.get(name="patient0")
+        pat.save()
+        self.assertEqual(7, pat._seq)
+
+    def test_bulk_create_queries(self):
+        # Warm up the datastore metadata cache
+        Patient.objects.bulk_create(_patients(self.org, 1))
+
+        # The number of queries doesn't depend on the number of objects
+        with CaptureQueriesContext(connection) as ctx:
+            Patient.objects.bulk_create(_patients(self.org, 2))
+        num_queries = len(ctx.captured_queries)
+        with self.assertNumQueries(num_queries):
+            Patient.objects.bulk_create(_patients(self.org, 50))
+
+    def test_bulk_update(self):
+        Patient.objects.bulk_create(_patients(self.org, 3))
+        pats = list(Patient.objects.order_by("_seq"))
+        revs = [pat._rev for pat in pats]
+        for pat in pats:
+            pat.age = 99
+
+        Patient.objects.bulk_update(pats, ["age"])
+
+        pats = list(Patient.objects.order_by("_seq"))
+        self.assertEqual([5, 6, 7], [pat._seq for pat in pats])
+        for pat, rev in zip(pats, revs):
+            self.assertEqual(99, pat.age)
+            self.assertGreater(
+                VectorClock.from_string(pat._rev), VectorClock.from_string(rev)
+            )
+
+    def test_queryset_delete(self):
+        Patient.objects.bulk_create(_patients(self.org, 4))
+        old_revs = dict(Patient.objects.values_list("_id", "_rev"))
+        Patient.objects.filter(name="patient3").get().delete()
+
+        # patient3 was already deleted, so it's not counted again
+        self.assertEqual(
+            (2, {"test_reldatasync_app.Patient": 2}),
+            Patient.objects.filter(age__gte=1).delete(),
+        )
+
+        # rows are still there, as tombstones with new revs and seqs
+        self.assertEqual(4, Patient.objects.count())
+        self.assertEqual(
+            ["patient0"],
+            list(Patient.objects.filter(_deleted=False).values_list("name", flat=True)),
+        )
+        deleted = Patient.objects.filter(name__in=["patient1", "patient2"])
+        self.assertEqual([7, 8], sorted(pat._seq for pat in deleted))
+        for pat in deleted:
+            self.assertTrue(pat._deleted)
+            self.assertGreater(
+                VectorClock.from_string(pat._rev),
+                VectorClock.from_string(old_revs[pat._id]),
+            )
+        # patient3 kept its own tombstone
+        self.assertEqual(6, Patient.objects.get(name="patient3")._seq)
+
+        # soft_delete is the same thing
+        self.assertEqual(1, Patient.objects.all().soft_delete()[0])
+        self.assertEqual(0, Patient.objects.filter(_deleted=False).count())
+
+        # hard_delete really removes rows
+        Patient.objects.all().hard_delete()
+        self.assertEqual(0, Patient.objects.count())
+
+    def test_queryset_delete_queries(self):
+        Patient.objects.bulk_create(_patients(self.org, 50))
+        Patient.objects.filter(age__lt=2).delete()
+
+        # The number of queries doesn't depend on the number of rows
+        with CaptureQueriesContext(connection) as ctx:
+            Patient.objects.filter(age__lt=4).delete()
+        num_queries = len(ctx.captured_queries)
+        with self.assertNumQueries(num_queries):
+            self.assertEqual(46, Patient.objects.all().delete()[0])
+
+    def test_bulk_rev_length(self):
+        pat = _patients(self.org, 1)[0]
+        rev = VectorClock({"z" * (SyncableModel.REV_LENGTH + 1): 10})
+        pat._rev = str(rev)
+        with self.assertRaises(ValueError):
+            Patient.objects.bulk_create([pat])
+
+
+@skipUnless(BENCHMARK_NUM, "Set RDS_BENCHMARK_NUM to run benchmarks")
+class BulkBenchmark(TransactionTestCase):
+    """Compare bulk writes and QuerySet.delete with writing each object."""
+
+    def setUp(self):
+        self.org = Organization(name="org")
+        self.org.save()
+
+    def _report(self, name, func):
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        print(
+            f"\n{name}: {BENCHMARK_NUM} objects in {elapsed:.3f}s"
+            f" ({BENCHMARK_NUM / elapsed:.0f}/s),"
+            f" {len(ctx.captured_queries)} queries"
+        )
+
+    def test_create(self):
+        def save_each():
+            for pat in _patients(self.org, BENCHMARK_NUM):
+                pat.save()
+
+        self._report("save() each", save_each)
+        self._report(
+            "bulk_create",
+            lambda: Patient.objects.bulk_create(_patients(self.org, BENCHMARK_NUM)),
+        )
+
+    def test_update(self):
+        Patient.objects.bulk_create(_patients(self.org, BENCHMARK_NUM))
+        pats = list(Patient.objects.all())
+
+        def save_each():
+            for pat in pats:
+                pat.age += 1
+                pat.save()
+
+        def bulk_update():
+            for pat in pats:
+                pat.age += 1
+            Patient.objects.bulk_update(pats, ["age"])
+
+        self._report("save() each", save_each)
+        self._report("bulk_update", bulk_update)
+
+    def test_delete(self):
+        Patient.objects.bulk_create(_patients(self.org, 2 * BENCHMARK_NUM))
+        pats = list(Patient.objects.order_by("_seq")[:BENCHMARK_NUM])
+
+        def delete_each():
+            for pat in pats:
+                pat.delete()
+
+        self._report("delete() each", delete_each)
+        self._report(
+            "QuerySet.delete", lambda: Patient.objects.filter(_deleted=False).delete()
+        )
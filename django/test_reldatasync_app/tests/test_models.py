@@ -1,6 +1,7 @@
 from django.test import TransactionTestCase
 from reldatasync.datastore import NoSuchTable
-from reldatasync_app.models import DataSyncRevisions, SyncableModel
+from reldatasync_app.models import DataSyncRevisions, SyncableModel, metadata_cache
+from reldatasync_app.registry import registry
 from test_reldatasync_app.models import DATASTORE_NAME, Organization, Patient
 
 
@@ -17,6 +18,39 @@ class ModelsTest(TransactionTestCase):
         )
         self.assertIsNone(SyncableModel.get_table_by_class_name("oops"))
 
+    def test_registry(self):
+        info = registry.get_by_class_name("Patient")
+        self.assertIs(Patient, info.model)
+        self.assertIs(info, registry.get_by_table(Patient._meta.db_table))
+        self.assertEqual(DATASTORE_NAME, info.datastore_name)
+        self.assertEqual(
+            [
+                "_id",
+                "_rev",
+                "_seq",
+                "_deleted",
+                "name",
+                "residence",
+                "age",
+                "birth_date",
+                "created_dt",
+                "email",
+                "org_id",
+            ],
+            info.columns,
+        )
+        self.assertEqual("TEXT", info.schema.field_type("_id"))
+        self.assertEqual("INTEGER", info.schema.field_type("_seq"))
+        self.assertEqual("BOOLEAN", info.schema.field_type("_deleted"))
+        self.assertEqual("DATE", info.schema.field_type("birth_date"))
+        self.assertEqual("DATETIME", info.schema.field_type("created_dt"))
+        # foreign key has the type of the key it points to
+        self.assertEqual("TEXT", info.schema.field_type("org_id"))
+
+        # abstract models are not registered
+        self.assertIsNone(registry.get_by_class_name("IntermediateSyncableModel"))
+        self.assertIsNone(registry.get_by_class_name("SyncableModel"))
+
     def test_syncable_model_get_datastore(self):
         # bad names still result in a datastore object, because it is a wrapper
         # It won't work, though
@@ -43,3 +77,25 @@ class ModelsTest(TransactionTestCase):
         with ds:
             # now we have an org
             self.assertEqual(1, ds.sequence_id)
+
+    def test_get_datastore_metadata_cache(self):
+        metadata_cache.clear()
+        table = SyncableModel.get_table_by_class_name("Organization")
+        ds = SyncableModel.get_datastore_by_name(DATASTORE_NAME, table)
+        # First time: insert datastore id, read it, and read table metadata
+        with self.assertNumQueries(3):
+            with ds:
+                self.assertEqual(0, ds.sequence_id)
+        self.assertEqual(1, len(metadata_cache))
+
+        # After that, only read the datastore id and sequence id
+        ds = SyncableModel.get_datastore_by_name(DATASTORE_NAME, table)
+        with self.assertNumQueries(1):
+            with ds:
+                self.assertEqual(0, ds.sequence_id)
+
+        # The cached datastore still works
+        org = Organization(name="org")
+        org.save()
+        with ds:
+            self.assertEqual("org", ds.get(org._id)["name"])
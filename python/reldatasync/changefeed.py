@@ -0,0 +1,132 @@
+"""Notify waiters when a datastore's sequence id moves, so clients need not poll."""
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import Optional
+
+from reldatasync.replicator import Replicator
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceNotifier:
+    """Wake up threads waiting for a sequence id to pass a watermark.
+
+    This is in-process only.  Writers call notify() after their changes are
+    visible (e.g., committed).  Waiters in other processes still see the
+    change, since wait() re-reads the sequence id every poll_interval.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._sequence_ids = {}
+        # bumped on every notify, so a waiter can't miss one
+        self._generation = 0
+
+    def notify(self, key: str, sequence_id: int) -> None:
+        """Record that key (e.g., a datastore name) is at sequence_id."""
+        with self._cond:
+            if sequence_id > self._sequence_ids.get(key, 0):
+                self._sequence_ids[key] = sequence_id
+            self._generation += 1
+            self._cond.notify_all()
+
+    def sequence_id(self, key: str) -> int:
+        """Return the last sequence id notified for key, or zero."""
+        with self._cond:
+            return self._sequence_ids.get(key, 0)
+
+    def wait(
+        self,
+        key: str,
+        the_seq: int,
+        timeout: float,
+        get_sequence_id: Optional[Callable[[], int]] = None,
+        poll_interval: float = 1.0,
+    ) -> int:
+        """Wait until the sequence id of key is > the_seq, or timeout.
+
+        :param key  Key given to notify()
+        :param the_seq  Watermark to pass
+        :param timeout  Maximum seconds to wait
+        :param get_sequence_id  Read the current sequence id (e.g., from the
+            database).  If not given, use the last one notified.
+        :param poll_interval  Seconds between reads of get_sequence_id if
+            nothing is notified
+        :return the current sequence id, which is <= the_seq on timeout
+        """
+        if get_sequence_id is None:
+            get_sequence_id = functools.partial(self.sequence_id, key)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                generation = self._generation
+            seq = get_sequence_id()
+            remaining = deadline - time.monotonic()
+            if seq > the_seq or remaining <= 0:
+                return seq
+            with self._cond:
+                if generation == self._generation:
+                    self._cond.wait(min(remaining, poll_interval))
+
+    def stream(
+        self,
+        key: str,
+        the_seq: int,
+        timeout: float,
+        get_sequence_id: Optional[Callable[[], int]] = None,
+        poll_interval: float = 1.0,
+        keepalive: float = 15.0,
+    ) -> Iterator[str]:
+        """Yield server-sent events each time the sequence id of key moves.
+
+        Each event has the sequence id as its id (so a reconnecting client
+        can send Last-Event-ID), and data {"current_sequence_id": seq}.
+        Yield a comment every keepalive seconds without a change.
+        Stop after timeout.
+
+        See https://html.spec.whatwg.org/multipage/server-sent-events.html
+        """
+        deadline = time.monotonic() + timeout
+        remaining = timeout
+        while remaining > 0:
+            seq = self.wait(
+                key,
+                the_seq,
+                min(remaining, keepalive),
+                get_sequence_id=get_sequence_id,
+                poll_interval=poll_interval,
+            )
+            if seq > the_seq:
+                the_seq = seq
+                data = json.dumps({"current_sequence_id": seq})
+                yield f"id: {seq}\nevent: sequence_id\ndata: {data}\n\n"
+            else:
+                yield ": keepalive\n\n"
+            remaining = deadline - time.monotonic()
+
+
+# Notifier shared by everything in this process
+notifier = SequenceNotifier()
+
+
+def pull_when_notified(replicator: Replicator, timeout: float = 30) -> int:
+    """Wait for replicator.destination to change, and only then pull changes.
+
+    The destination must have wait_for_changes(), e.g. a
+    RestClientSourceDatastore.
+
+    :return number of docs changed, which is 0 if nothing changed before timeout
+    """
+    source = replicator.source
+    destination = replicator.destination
+    the_seq = source.get_peer_sequence_id(destination.id)
+    if destination.wait_for_changes(the_seq, timeout) <= the_seq:
+        logger.debug(f"{destination.id}: no changes after {the_seq}")
+        return 0
+    return replicator.pull_changes()
@@ -1,21 +1,40 @@
 """An abstraction of a datastore, to use for syncing."""
 
+import contextlib
 import functools
+import gzip
+import io
+import json
 import logging
+import re
 import sqlite3
+import threading
 from abc import ABC, abstractmethod
 from collections import OrderedDict
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
 from typing import Generic, Optional
 
 import psycopg2
 import requests
 from reldatasync import util
-from reldatasync.document import _DELETED, _ID, _REV, _SEQ, ID_TYPE, Document
+from reldatasync.document import (
+    _BASE_REV,
+    _DELETED,
+    _DELTA,
+    _ID,
+    _REV,
+    _SEQ,
+    _TABLE,
+    ID_TYPE,
+    Document,
+)
 from reldatasync.vectorclock import VectorClock
 
 logger = logging.getLogger(__name__)
 
+# Version of the file write_snapshot writes
+SNAPSHOT_FORMAT = 1
+
 
 class Datastore(Generic[ID_TYPE], ABC):
     def __init__(self, datastore_name: str, datastore_id: Optional[str] = None):
@@ -33,6 +52,12 @@ class Datastore(Generic[ID_TYPE], ABC):
             self.id = util.uuid4_string()
         self._sequence_id = 0
         self.peer_seq_ids = {}
+        # How far each peer has pulled from us, see ack_peer_sequence_id
+        self.peer_acks = {}
+        self._purged_sequence_id = 0
+        # If True, put records in _DELTA which fields changed, so
+        # get_deltas_since can send only those
+        self.track_deltas = False
 
     def __enter__(self):
         pass
@@ -40,6 +65,14 @@ class Datastore(Generic[ID_TYPE], ABC):
     def __exit__(self, *args):
         pass
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commit what the body does together, or roll it back if it raises.
+
+        Datastores without transactions just run the body.
+        """
+        yield
+
     def check(self, max_size=1000):
         """Do some sanity checks.  Return True if they pass.
 
@@ -77,7 +110,8 @@ class Datastore(Generic[ID_TYPE], ABC):
                 logger.warning(f"doc {docid} has seq out of bounds {seq}")
                 ret = False
 
-        if max_seq != doc_max_seq:
+        # The doc with max_seq may have been a purged tombstone
+        if max_seq != doc_max_seq and max_seq > self.get_purged_sequence_id():
             logger.warning(f"doc_max_seq {doc_max_seq} max_seq reported {max_seq}")
             ret = False
 
@@ -97,8 +131,11 @@ class Datastore(Generic[ID_TYPE], ABC):
             logger.debug(f"len(docs1) = {len(docs1)} != len(docs2) = {len(docs2)}")
             return False
 
+        # _DELTA is local too, it has our _SEQ of the doc before
+        ignore_keys = {_SEQ, _DELTA}
+
         def compare_no_seq(a, b):
-            return a.compare(b, ignore_keys={_SEQ})
+            return a.compare(b, ignore_keys=ignore_keys)
 
         docs1 = sorted(docs1, key=functools.cmp_to_key(compare_no_seq))
         docs2 = sorted(docs2, key=functools.cmp_to_key(compare_no_seq))
@@ -112,7 +149,7 @@ class Datastore(Generic[ID_TYPE], ABC):
 
         # pylint: disable-next=consider-using-enumerate
         for idx in range(len(docs1)):
-            if docs1[idx].compare(docs2[idx], ignore_keys={_SEQ}) != 0:
+            if docs1[idx].compare(docs2[idx], ignore_keys=ignore_keys) != 0:
                 logger.debug(
                     "First unequal element: "
                     f"{self.id} docs[{idx}]={docs1[idx]}\n"
@@ -129,6 +166,20 @@ class Datastore(Generic[ID_TYPE], ABC):
         )
         return self._sequence_id
 
+    def _reserve_sequence_ids(self, num: int) -> Sequence[int]:
+        """Increment sequence id by num, and return the num ids passed.
+
+        The ids are increasing, but may not be contiguous (see
+        PostgresDatastore use_sequence).
+        """
+        first = self._sequence_id + 1
+        self._sequence_id += num
+        logger.debug(
+            f"{self.id}: Increment {self.id} _sequence_id by {num}"
+            f" to {self._sequence_id}"
+        )
+        return range(first, self._sequence_id + 1)
+
     def _set_sequence_id(self, the_id) -> None:
         """Set sequence id to the_id."""
         if the_id < self._sequence_id:
@@ -159,6 +210,18 @@ class Datastore(Generic[ID_TYPE], ABC):
         rev.set_clock(self.id, seq_id)
         return str(rev), seq_id
 
+    def new_revs_and_seqs(self, rev_strs: Sequence[str]) -> list[tuple[str, int]]:
+        """Like new_rev_and_seq, for a batch, with one sequence id update."""
+        if not rev_strs:
+            return []
+        seq_ids = self._reserve_sequence_ids(len(rev_strs))
+        ret = []
+        for rev_str, seq_id in zip(rev_strs, seq_ids):
+            rev = VectorClock.from_string(rev_str or "{}")
+            rev.set_clock(self.id, seq_id)
+            ret.append((str(rev), seq_id))
+        return ret
+
     @abstractmethod
     def _put(self, doc: Document):
         pass
@@ -180,6 +243,8 @@ class Datastore(Generic[ID_TYPE], ABC):
             )
 
         assert doc.__class__ == Document, f"doc class is {doc.__class__}"
+        if _BASE_REV in doc:
+            raise ValueError(f"doc {doc[_ID]} is a patch, use put_deltas")
 
         # copy doc so we don't modify caller's doc
         doc = doc.copy()
@@ -205,7 +270,10 @@ class Datastore(Generic[ID_TYPE], ABC):
         my_doc = self.get(docid, include_deleted=True)
 
         my_rev = VectorClock.from_string(my_doc.get(_REV)) if my_doc else None
-        if (my_rev is None) or (my_rev < rev):
+        if my_doc is None and self._was_purged(doc, rev):
+            # Don't bring back a tombstone every peer already has
+            logger.debug(f"{self.id}: Ignore docid {docid}, we purged it")
+        elif (my_rev is None) or (my_rev < rev):
             seq_id = self._increment_sequence_id()
             if increment_rev:
                 # Now assign the rev for real
@@ -217,6 +285,7 @@ class Datastore(Generic[ID_TYPE], ABC):
                 ), "rev did not increase: {rev} !> {doc[_REV]} "
                 doc[_REV] = str(rev)
             doc[_SEQ] = seq_id
+            self._set_delta(doc, my_doc)
             self._put(doc)
             ret = 1
 
@@ -233,6 +302,120 @@ class Datastore(Generic[ID_TYPE], ABC):
             )
         return ret, doc
 
+    def put_many(self, docs: Sequence[Document]) -> int:
+        """Put docs that have revs, as put() does, e.g., a chunk from a peer.
+
+        Return number of docs actually put.
+        """
+        num_put = 0
+        for doc in docs:
+            num, _new_doc = self.put(doc)
+            num_put += num
+        return num_put
+
+    def _set_delta(self, doc: Document, my_doc: Optional[Document]) -> None:
+        """Record in doc's _DELTA which fields changed since my_doc, the
+        version it replaces, if we track deltas."""
+        if not self.track_deltas:
+            # A peer's _DELTA is about its seqs, not ours
+            doc.pop(_DELTA, None)
+            return
+        if my_doc is None:
+            doc.pop(_DELTA, None)
+            return
+        fields = (doc.keys() | my_doc.keys()) - {_ID, _REV, _SEQ, _DELTA, _TABLE}
+        doc[_DELTA] = json.dumps(
+            {
+                "base_rev": my_doc[_REV],
+                "base_seq": my_doc[_SEQ],
+                "rev": doc[_REV],
+                "fields": sorted(
+                    field for field in fields if doc.get(field) != my_doc.get(field)
+                ),
+            }
+        )
+
+    @staticmethod
+    def _to_patch(doc: Document, the_seq: int) -> Document:
+        """Return a patch of doc's last change, or doc if a peer that has
+        pulled our docs up to the_seq can't have the version it patches."""
+        if not doc.get(_DELTA):
+            return doc
+        delta = json.loads(doc[_DELTA])
+        # Someone wrote the doc without put, or the base came after the_seq
+        if delta["rev"] != doc[_REV] or delta["base_seq"] > the_seq:
+            return doc
+        patch = Document(
+            {
+                field: doc[field]
+                for field in (_ID, _REV, _SEQ, _DELTA, _TABLE, *delta["fields"])
+                if field in doc
+            }
+        )
+        patch[_BASE_REV] = delta["base_rev"]
+        return patch
+
+    def get_deltas_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
+        """Like get_docs_since, but send patches instead of whole docs where
+        we can, for put_deltas.
+
+        A patch has the fields its last put changed, and _BASE_REV, the rev
+        of the version it changed.  A peer with that version can make the new
+        one from it.  Only datastores that track_deltas make patches.
+        """
+        seq, docs = self.get_docs_since(the_seq, num, where)
+        return seq, [self._to_patch(doc, the_seq) for doc in docs]
+
+    def _apply_patch(self, patch: Document) -> Optional[Document]:
+        """Return the doc patch makes from ours, or None if we don't have the
+        version it patches."""
+        my_doc = self.get(patch[_ID], include_deleted=True)
+        if my_doc is None or VectorClock.from_string(
+            my_doc[_REV]
+        ) != VectorClock.from_string(patch[_BASE_REV]):
+            return None
+        doc = my_doc
+        for field in json.loads(patch[_DELTA])["fields"]:
+            if field in patch:
+                doc[field] = patch[field]
+            else:
+                doc.pop(field, None)
+        for field in (_REV, _SEQ, _DELTA, _TABLE):
+            if field in patch:
+                doc[field] = patch[field]
+        return doc
+
+    def put_deltas(self, docs: Sequence[Document]) -> tuple[int, list[int]]:
+        """put_many docs from get_deltas_since, some of which may be patches.
+
+        :return number of docs put, and the _SEQ of each patch we can't
+            apply, since we don't have the version it patches.  Put the
+            whole docs for those.
+        """
+        whole_docs = []
+        missing_seqs = []
+        for doc in docs:
+            if _BASE_REV not in doc:
+                whole_docs.append(doc)
+                continue
+            whole_doc = self._apply_patch(doc)
+            if whole_doc is None:
+                missing_seqs.append(doc[_SEQ])
+            else:
+                whole_docs.append(whole_doc)
+        return self.put_many(whole_docs), missing_seqs
+
+    def _was_purged(self, doc: Document, rev: VectorClock) -> bool:
+        """True if doc is a tombstone for a doc we don't have, but had.
+
+        Only purge_tombstones removes docs, so if doc has our clock, and we
+        don't have it, we purged it.
+        """
+        our_seq = rev.get_clock(self.id, 0)
+        return doc.get(_DELETED, False) and 0 < our_seq <= self.get_purged_sequence_id()
+
     def delete(self, docid: ID_TYPE) -> None:
         """Delete an doc in the datastore.
 
@@ -241,11 +424,13 @@ class Datastore(Generic[ID_TYPE], ABC):
         doc = self.get(docid)
         assert doc is None or _REV in doc
         if doc and not doc.get(_DELETED, False):
+            my_doc = doc.copy()
             doc[_DELETED] = True
             # Deletion makes a increment_rev rev
             seq_id = self._increment_sequence_id()
             doc[_SEQ] = seq_id
             self._set_new_rev(doc, seq_id)
+            self._set_delta(doc, my_doc)
             logger.debug(f"{self.id}: after delete {doc}")
             self._put(doc)
 
@@ -259,17 +444,102 @@ class Datastore(Generic[ID_TYPE], ABC):
             logger.debug(f"{self.id}: set peer_seq_ids[{peer}] = {seq}")
             self.peer_seq_ids[peer] = seq
 
+    def ack_peer_sequence_id(self, peer: str, seq: int) -> None:
+        """Record that peer has pulled all our docs with _seq <= seq.
+
+        This registers peer if it is new.  Registered peers hold back
+        purge_tombstones until they have seen the tombstones, so forget
+        peers that will not sync again.
+        """
+        if peer not in self.peer_acks or seq > self.peer_acks[peer]:
+            logger.debug(f"{self.id}: set peer_acks[{peer}] = {seq}")
+            self.peer_acks[peer] = seq
+
+    def forget_peer(self, peer: str) -> None:
+        """Stop keeping tombstones for peer.
+
+        If peer syncs again after they are purged, it needs a full resync.
+        """
+        self.peer_acks.pop(peer, None)
+
+    def get_peer_acks(self) -> dict[str, int]:
+        """Return {peer: seq} for registered peers, see ack_peer_sequence_id."""
+        return dict(self.peer_acks)
+
+    def get_purged_sequence_id(self) -> int:
+        """Tombstones with _seq <= this may have been purged."""
+        return self._purged_sequence_id
+
+    def _set_purged_sequence_id(self, seq: int) -> None:
+        self._purged_sequence_id = max(self._purged_sequence_id, seq)
+
+    def gc_horizon(self) -> int:
+        """Return the seq every registered peer has pulled up to.
+
+        Zero if there are no registered peers, so nothing is purged.
+        """
+        acks = self.get_peer_acks()
+        if not acks:
+            return 0
+        return min(self.sequence_id, *acks.values())
+
+    def check_peer_sequence_id(self, seq: int) -> None:
+        """Raise ResyncRequired if a peer that pulled up to seq missed tombstones.
+
+        A new peer (seq 0) is fine, unless it got our docs some other way.
+        """
+        purged = self.get_purged_sequence_id()
+        if 0 < seq < purged:
+            raise ResyncRequired(
+                f"{self.id}: peer sequence id {seq} is behind"
+                f" purged sequence id {purged}"
+            )
+
+    def purge_tombstones(self) -> int:
+        """Remove deleted docs that every registered peer has pulled.
+
+        :return number of docs removed
+        """
+        horizon = self.gc_horizon()
+        num = self._purge_tombstones(horizon) if horizon > 0 else 0
+        self._set_purged_sequence_id(horizon)
+        logger.debug(f"{self.id}: purged {num} tombstones up to seq {horizon}")
+        return num
+
+    @staticmethod
+    def _matches(doc: Document, where: Optional[dict]) -> bool:
+        """True if doc has the field values in where (see get_docs_since)."""
+        for field, value in (where or {}).items():
+            if isinstance(value, list):
+                if doc.get(field) not in value:
+                    return False
+            elif doc.get(field) != value:
+                return False
+        return True
+
+    def _purge_tombstones(self, the_seq: int) -> int:
+        """Remove deleted docs with _seq <= the_seq, return how many."""
+        raise NotImplementedError(f"{self.__class__.__name__} can't purge tombstones")
+
     @abstractmethod
     def get(self, docid: ID_TYPE, include_deleted=False) -> Document:
         pass
 
     @abstractmethod
-    def get_docs_since(self, the_seq: int, num: int) -> tuple[int, Sequence[Document]]:
+    def get_docs_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
         """Get docs put with the_seq < seq <= (the_seq+num).
 
         This is intended to be called repeatedly to get them all, so as to
         allow syncing in chunks.
 
+        :param where  If given, only docs with these field values, e.g.
+            {"org_id": "X"}.  A list value matches any value in it.  Other
+            docs are left out, but the current sequence id is the same, so
+            the caller has every doc it wants up to it.  A doc that stops
+            matching isn't returned again, so the caller keeps its old one.
+
         :return current sequence id, sequence of about "num" oldest docs
 
         The current sequence id is useful to know if we've reached the end
@@ -284,13 +554,79 @@ class Datastore(Generic[ID_TYPE], ABC):
         min(the_seq+num, current sequence id).
         """
 
+    def write_snapshot(
+        self, fileobj, chunk_size: int = 1000, where: Optional[dict] = None
+    ) -> int:
+        """Write all our docs to binary fileobj, to bootstrap a new peer.
+
+        The file is gzipped JSON lines: a header with our id and a sequence
+        id, then docs, including all with _seq up to that sequence id.
+        A peer that loads it can pull from that sequence id on, since docs
+        that change while we write get seqs past it.
+
+        :param where  Only docs with these field values, see get_docs_since
+        :return the sequence id of the snapshot
+        """
+        seq, docs = self.get_docs_since(0, chunk_size, where)
+        with gzip.GzipFile(fileobj=fileobj, mode="wb") as out:
+            header = {
+                "snapshot_format": SNAPSHOT_FORMAT,
+                "datastore_id": self.id,
+                "sequence_id": seq,
+            }
+            out.write(json.dumps(header).encode("utf-8") + b"\n")
+            the_seq = chunk_size
+            while True:
+                for doc in docs:
+                    out.write(json.dumps(doc, default=str).encode("utf-8") + b"\n")
+                if the_seq >= seq:
+                    break
+                _, docs = self.get_docs_since(the_seq, chunk_size, where)
+                the_seq += chunk_size
+        logger.debug(f"{self.id}: wrote snapshot at sequence id {seq}")
+        return seq
+
+    def load_snapshot(self, fileobj, chunk_size: int = 1000) -> tuple[int, int]:
+        """Put the docs from a write_snapshot file, with put_many.
+
+        Afterwards, pull from the snapshot's datastore starting at the
+        snapshot's sequence id (Replicator does this).
+
+        :return sequence id of the snapshot, number of docs put
+        """
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as snapshot:
+            header = json.loads(snapshot.readline())
+            if header.get("snapshot_format") != SNAPSHOT_FORMAT:
+                raise ValueError(
+                    f"Unknown snapshot format {header.get('snapshot_format')}"
+                )
+            num_put = 0
+            docs = []
+            for line in snapshot:
+                docs.append(Document(json.loads(line)))
+                if len(docs) >= chunk_size:
+                    num_put += self.put_many(docs)
+                    docs = []
+            num_put += self.put_many(docs)
+        logger.debug(
+            f"{self.id}: loaded {num_put} docs from snapshot of"
+            f" {header['datastore_id']} at sequence id {header['sequence_id']}"
+        )
+        return header["sequence_id"], num_put
+
 
 class MemoryDatastore(Datastore):
     """An in-memory transient datastore, only useful for testing."""
 
-    def __init__(self, datastore_name: str, datastore_id: Optional[str] = None):
+    def __init__(
+        self,
+        datastore_name: str,
+        datastore_id: Optional[str] = None,
+        track_deltas: bool = False,
+    ):
         super().__init__(datastore_name, datastore_id)
         self.datastore = OrderedDict()
+        self.track_deltas = track_deltas
 
     def get(self, docid: ID_TYPE, include_deleted=False) -> Document:
         """Return doc, or None if not present.
@@ -315,7 +651,9 @@ class MemoryDatastore(Datastore):
         # preserve doc key order
         self.datastore.move_to_end(docid)
 
-    def get_docs_since(self, the_seq: int, num: int) -> tuple[int, Sequence[Document]]:
+    def get_docs_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
         """Get docs put with the_seq < seq <= (the_seq+num).
 
         This is intended to be called repeatedly to get them all, so as to
@@ -327,7 +665,7 @@ class MemoryDatastore(Datastore):
         for _docid, doc in self.datastore.items():
             doc_seq = doc[_SEQ]
             assert doc_seq is not None
-            if the_seq < doc_seq <= (the_seq + num):
+            if the_seq < doc_seq <= (the_seq + num) and self._matches(doc, where):
                 docs.append(doc)
             # Since self.datastore is ordered, we can cut out early
             # This is optional, perhaps premature optimization
@@ -335,11 +673,54 @@ class MemoryDatastore(Datastore):
                 break
         return self.sequence_id, docs
 
+    def _purge_tombstones(self, the_seq: int) -> int:
+        docids = [
+            docid
+            for docid, doc in self.datastore.items()
+            if doc.get(_DELETED, False) and doc[_SEQ] <= the_seq
+        ]
+        for docid in docids:
+            del self.datastore[docid]
+        return len(docids)
+
 
 class NoSuchTable(Exception):
     pass
 
 
+class ResyncRequired(Exception):
+    """A peer is behind purged tombstones, so it must sync from scratch."""
+
+
+class TableMetadataCache:
+    """Table column names and SQL text, shared between database datastores.
+
+    DatabaseDatastore.__enter__ queries its table to find the column names.
+    Datastores that share a cache and a cache key only do that once.
+    Call clear() when the schema changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key) -> Optional[dict]:
+        with self._lock:
+            return self._entries.get(key, None)
+
+    def set(self, key, entry: dict) -> None:
+        with self._lock:
+            self._entries[key] = entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
 class DatabaseDatastore(Datastore, ABC):
     """Base datastore for a relational database."""
 
@@ -349,12 +730,34 @@ class DatabaseDatastore(Datastore, ABC):
         conn,
         tablename: str,
         datastore_id: Optional[str] = None,
+        metadata_cache: Optional[TableMetadataCache] = None,
+        cache_key=None,
+        track_peers: bool = False,
     ):
+        """Init a database datastore.
+
+        :param metadata_cache  If given, get table metadata from here, and put
+                               it here the first time
+        :param cache_key  Key in metadata_cache.
+                          Default: (datastore_name, tablename)
+        :param track_peers  If True, keep peer acks in table data_sync_peers,
+                            peer sequence ids in data_sync_peer_seqs, and the
+                            purged sequence id in data_sync_revisions, instead
+                            of in memory.  Needed to purge tombstones safely
+                            across processes, and to commit how far we pulled
+                            with the docs (see transaction).
+        """
         super().__init__(datastore_name, datastore_id)
         self.tablename = tablename
         self.conn = conn
         self.columnnames = None
         self.cursor = None
+        self.metadata_cache = metadata_cache
+        self.cache_key = cache_key or (datastore_name, tablename)
+        self._upsert_statement = None
+        self.track_peers = track_peers
+        # How many transaction() bodies we're in
+        self._transaction_depth = 0
 
         # set in child class
         self.placeholder = None
@@ -368,8 +771,32 @@ class DatabaseDatastore(Datastore, ABC):
         # Treat '_deleted' specially: get rid of it if it's None
         if the_dict[_DELETED] is None:
             del the_dict[_DELETED]
+        # and '_delta', which new docs don't have
+        if the_dict.get(_DELTA, "") is None:
+            del the_dict[_DELTA]
         return Document(the_dict)
 
+    def _where_sql(self, where: Optional[dict]) -> tuple[str, list]:
+        """Return SQL to AND to a WHERE clause for where (see
+        get_docs_since), and its parameters."""
+        sql = ""
+        params = []
+        for column, value in (where or {}).items():
+            # Column names go in the SQL, so only allow ours
+            if column not in self.columnnames:
+                raise ValueError(f"No column '{column}' in table '{self.tablename}'")
+            if isinstance(value, list):
+                if not value:
+                    sql += " AND 1 = 0"
+                    continue
+                placeholders = ", ".join(self.placeholder for _ in value)
+                sql += f" AND {column} IN ({placeholders})"
+                params.extend(value)
+            else:
+                sql += f" AND {column} = {self.placeholder}"
+                params.append(value)
+        return sql, params
+
     def __enter__(self):
         super().__enter__()
 
@@ -383,6 +810,36 @@ class DatabaseDatastore(Datastore, ABC):
         # Check that the right tables exist
         self._init_datastore_id()
 
+        entry = None
+        if self.metadata_cache is not None:
+            entry = self.metadata_cache.get(self.cache_key)
+        if entry:
+            self.columnnames = entry["columnnames"]
+            self._upsert_statement = entry["upsert_statement"]
+        else:
+            self._init_table_metadata()
+            if self.metadata_cache is not None:
+                self.metadata_cache.set(
+                    self.cache_key,
+                    {
+                        "columnnames": self.columnnames,
+                        "upsert_statement": self._upsert_statement,
+                    },
+                )
+
+        # Tables with a _DELTA column get patches (see get_deltas_since)
+        self.track_deltas = _DELTA in self.columnnames
+
+        # TODO: Check self.tablename has a unique index on _id
+        # Required for proper functioning of UPSERT
+
+        # TODO: Check that sequence_id in revisions table is >= max(REV)
+        #   in the data
+
+        return self
+
+    def _init_table_metadata(self):
+        """Set self.columnnames and the SQL that depends on them."""
         # Get the column names for self.tablename
         try:
             self.cursor.execute(f"SELECT * FROM {self.tablename} LIMIT 0")
@@ -404,18 +861,70 @@ class DatabaseDatastore(Datastore, ABC):
             if field not in self.columnnames:
                 raise NameError(f"Field '{field}' not in table '{self.tablename}'")
 
-        # TODO: Check self.tablename has a unique index on _id
-        # Required for proper functioning of UPSERT
-
-        # TODO: Check that sequence_id in revisions table is >= max(REV)
-        #   in the data
-
-        return self
+        # "ON CONFLICT" added to sqlite upsert in version 3.24.0 (2018-06-04)
+        # "ON CONFLICT" requires Postgres 9.5+
+        set_statement = ", ".join(f"{col}=EXCLUDED.{col} " for col in self.columnnames)
+        col_names = ",".join(self.columnnames)
+        values = ",".join([self.placeholder for _ in self.columnnames])
+        self._upsert_statement = (
+            f"INSERT INTO {self.tablename} ({col_names}) VALUES ({values})"
+            f" ON CONFLICT (_id) DO UPDATE"
+            f" SET {set_statement}"
+        )
 
     def __exit__(self, *args):
         super().__exit__()
         if self.cursor:
             self.cursor.close()
+            # So the datastore can be entered again
+            self.cursor = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the body in a transaction, committed at the end, or rolled back
+        if it raises.
+
+        Nested in another transaction(), use a savepoint, so an error rolls
+        back only the body.  The outermost one also commits whatever else was
+        done on the connection, so don't use it in a transaction you manage.
+        """
+        self._check_cursor()
+        # What we keep in memory goes back on rollback, too
+        old_state = (self._sequence_id, dict(self.peer_seq_ids))
+        depth = self._transaction_depth
+        if depth:
+            self.cursor.execute(f"SAVEPOINT rds_savepoint_{depth}")
+        else:
+            self._begin()
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            if depth:
+                self.cursor.execute(f"ROLLBACK TO SAVEPOINT rds_savepoint_{depth}")
+                self.cursor.execute(f"RELEASE SAVEPOINT rds_savepoint_{depth}")
+            else:
+                self._rollback()
+            self._sequence_id, self.peer_seq_ids = old_state
+            raise
+        finally:
+            self._transaction_depth = depth
+        if depth:
+            self.cursor.execute(f"RELEASE SAVEPOINT rds_savepoint_{depth}")
+        else:
+            self._commit()
+
+    @abstractmethod
+    def _begin(self) -> None:
+        """Start a transaction, if the connection doesn't start one itself."""
+
+    @abstractmethod
+    def _commit(self) -> None:
+        pass
+
+    @abstractmethod
+    def _rollback(self) -> None:
+        pass
 
     def _check_cursor(self):
         if self.cursor is None:
@@ -424,6 +933,10 @@ class DatabaseDatastore(Datastore, ABC):
                 "You must use this datastore in a 'with' statement"
             )
 
+    def _sequence_id_sql(self) -> str:
+        """SQL for the sequence id, in a query of data_sync_revisions."""
+        return "sequence_id"
+
     def _init_datastore_id(self):
         """Init datastore id and sequence_id.
 
@@ -432,7 +945,7 @@ class DatabaseDatastore(Datastore, ABC):
 
         Also raises an exception if the table doesn't exist."""
         self.cursor.execute(
-            "SELECT datastore_id, sequence_id FROM data_sync_revisions"
+            f"SELECT datastore_id, {self._sequence_id_sql()} FROM data_sync_revisions"
             f" WHERE datastore_name={self.placeholder}",
             (self.name,),
         )
@@ -502,6 +1015,25 @@ class DatabaseDatastore(Datastore, ABC):
 
         return new_val
 
+    def _reserve_sequence_ids(self, num: int) -> Sequence[int]:
+        self.cursor.execute(
+            f"UPDATE data_sync_revisions set sequence_id = sequence_id+{self.placeholder}"
+            f" WHERE datastore_id={self.placeholder}",
+            (num, self.id),
+        )
+        self.cursor.execute(
+            "SELECT sequence_id FROM data_sync_revisions"
+            f" WHERE datastore_id={self.placeholder}",
+            (self.id,),
+        )
+        new_val = self.cursor.fetchone()[0]
+        ret = super()._reserve_sequence_ids(num)
+        assert (
+            self._sequence_id == new_val
+        ), f"seq_id {self._sequence_id} DB seq_id {new_val}"
+
+        return ret
+
     def _put(self, doc: Document) -> None:
         """Put doc under docid.
 
@@ -509,21 +1041,104 @@ class DatabaseDatastore(Datastore, ABC):
         """
         assert _REV in doc
 
-        # "ON CONFLICT" added to sqlite upsert in version 3.24.0 (2018-06-04)
-        # "ON CONFLICT" requires Postgres 9.5+
-        set_statement = ", ".join(f"{col}=EXCLUDED.{col} " for col in self.columnnames)
-        col_names = ",".join(self.columnnames)
-        values = ",".join([self.placeholder for _ in self.columnnames])
-        upsert_statement = (
-            f"INSERT INTO {self.tablename} ({col_names}) VALUES ({values})"
-            f" ON CONFLICT (_id) DO UPDATE"
-            f" SET {set_statement}"
+        logger.debug(f"SQL: {self._upsert_statement}")
+        self.cursor.execute(
+            self._upsert_statement,
+            tuple(doc.get(key, None) for key in self.columnnames),
+        )
+
+    def get_peer_sequence_id(self, peer: str) -> int:
+        if not self.track_peers:
+            return super().get_peer_sequence_id(peer)
+        self._check_cursor()
+        self.cursor.execute(
+            "SELECT sequence_id FROM data_sync_peer_seqs"
+            f" WHERE datastore_id={self.placeholder} AND peer_id={self.placeholder}",
+            (self.id, peer),
+        )
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def set_peer_sequence_id(self, peer: str, seq: int) -> None:
+        if not self.track_peers:
+            super().set_peer_sequence_id(peer, seq)
+            return
+        self._check_cursor()
+        self.cursor.execute(
+            "INSERT INTO data_sync_peer_seqs (datastore_id, peer_id, sequence_id)"
+            f" VALUES ({self.placeholder}, {self.placeholder}, {self.placeholder})"
+            " ON CONFLICT (datastore_id, peer_id) DO UPDATE"
+            " SET sequence_id=EXCLUDED.sequence_id"
+            " WHERE data_sync_peer_seqs.sequence_id < EXCLUDED.sequence_id",
+            (self.id, peer, seq),
+        )
+
+    def ack_peer_sequence_id(self, peer: str, seq: int) -> None:
+        if not self.track_peers:
+            super().ack_peer_sequence_id(peer, seq)
+            return
+        self._check_cursor()
+        self.cursor.execute(
+            "INSERT INTO data_sync_peers (datastore_id, peer_id, sequence_id)"
+            f" VALUES ({self.placeholder}, {self.placeholder}, {self.placeholder})"
+            " ON CONFLICT (datastore_id, peer_id) DO UPDATE"
+            " SET sequence_id=EXCLUDED.sequence_id"
+            " WHERE data_sync_peers.sequence_id < EXCLUDED.sequence_id",
+            (self.id, peer, seq),
+        )
+
+    def forget_peer(self, peer: str) -> None:
+        if not self.track_peers:
+            super().forget_peer(peer)
+            return
+        self._check_cursor()
+        self.cursor.execute(
+            "DELETE FROM data_sync_peers"
+            f" WHERE datastore_id={self.placeholder} AND peer_id={self.placeholder}",
+            (self.id, peer),
         )
 
-        logger.debug(f"SQL: {upsert_statement}")
+    def get_peer_acks(self) -> dict[str, int]:
+        if not self.track_peers:
+            return super().get_peer_acks()
+        self._check_cursor()
         self.cursor.execute(
-            upsert_statement, tuple(doc.get(key, None) for key in self.columnnames)
+            "SELECT peer_id, sequence_id FROM data_sync_peers"
+            f" WHERE datastore_id={self.placeholder}",
+            (self.id,),
         )
+        return dict(self.cursor.fetchall())
+
+    def get_purged_sequence_id(self) -> int:
+        if not self.track_peers:
+            return super().get_purged_sequence_id()
+        self._check_cursor()
+        self.cursor.execute(
+            "SELECT COALESCE(purged_sequence_id, 0) FROM data_sync_revisions"
+            f" WHERE datastore_id={self.placeholder}",
+            (self.id,),
+        )
+        return self.cursor.fetchone()[0]
+
+    def _set_purged_sequence_id(self, seq: int) -> None:
+        if not self.track_peers:
+            super()._set_purged_sequence_id(seq)
+            return
+        self.cursor.execute(
+            f"UPDATE data_sync_revisions SET purged_sequence_id={self.placeholder}"
+            f" WHERE datastore_id={self.placeholder}"
+            f" AND COALESCE(purged_sequence_id, 0) < {self.placeholder}",
+            (seq, self.id, seq),
+        )
+
+    def _purge_tombstones(self, the_seq: int) -> int:
+        self._check_cursor()
+        self.cursor.execute(
+            f"DELETE FROM {self.tablename}"
+            f" WHERE _deleted AND _seq <= {self.placeholder}",
+            (the_seq,),
+        )
+        return self.cursor.rowcount
 
 
 class VersionError(Exception):
@@ -534,9 +1149,24 @@ class SqliteDatastore(DatabaseDatastore):
     """Sqlite datastore."""
 
     def __init__(
-        self, datastore_name: str, conn, tablename: str, datastore_id: str = None
+        self,
+        datastore_name: str,
+        conn,
+        tablename: str,
+        datastore_id: str = None,
+        metadata_cache: Optional[TableMetadataCache] = None,
+        cache_key=None,
+        track_peers: bool = False,
     ):
-        super().__init__(datastore_name, conn, tablename, datastore_id)
+        super().__init__(
+            datastore_name,
+            conn,
+            tablename,
+            datastore_id,
+            metadata_cache=metadata_cache,
+            cache_key=cache_key,
+            track_peers=track_peers,
+        )
         # check sqlite version
         if sqlite3.sqlite_version_info < (3, 24, 0):
             raise VersionError(
@@ -547,6 +1177,18 @@ class SqliteDatastore(DatabaseDatastore):
         # set up SQL vars
         self.placeholder = "?"
 
+    def _begin(self) -> None:
+        # sqlite3 only starts one itself before changes, and not if
+        # isolation_level is None
+        if not self.conn.in_transaction:
+            self.cursor.execute("BEGIN")
+
+    def _commit(self) -> None:
+        self.conn.commit()
+
+    def _rollback(self) -> None:
+        self.conn.rollback()
+
     def get(self, docid: ID_TYPE, include_deleted=False) -> Document:
         """Return doc, or None if not present."""
         doc = None
@@ -563,18 +1205,21 @@ class SqliteDatastore(DatabaseDatastore):
                 doc = None
         return doc
 
-    def get_docs_since(self, the_seq: int, num: int) -> tuple[int, Sequence[Document]]:
+    def get_docs_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
         """Get docs put with the_seq < seq <= (the_seq+num), ordered by seq.
 
         This is intended to be called repeatedly to get them all, so as to
         allow syncing in chunks.
         """
         self._check_cursor()
+        where_sql, where_params = self._where_sql(where)
         self.cursor.execute(
             f"SELECT * FROM {self.tablename}"
-            " WHERE ? < _seq AND _seq <= ?"
+            f" WHERE ? < _seq AND _seq <= ?{where_sql}"
             " ORDER BY _seq",
-            (the_seq, the_seq + num),
+            (the_seq, the_seq + num, *where_params),
         )
         docs = [self._row_to_doc(docrow) for docrow in self.cursor.fetchall()]
         return self.sequence_id, docs
@@ -582,10 +1227,143 @@ class SqliteDatastore(DatabaseDatastore):
 
 class PostgresDatastore(DatabaseDatastore):
     def __init__(
-        self, datastore_name: str, conn, tablename: str, datastore_id: str = None
+        self,
+        datastore_name: str,
+        conn,
+        tablename: str,
+        datastore_id: str = None,
+        metadata_cache: Optional[TableMetadataCache] = None,
+        cache_key=None,
+        track_peers: bool = False,
+        use_sequence: bool = False,
+        bulk_load_min_docs: Optional[int] = 100,
     ):
-        super().__init__(datastore_name, conn, tablename, datastore_id)
+        """Init a Postgres datastore.
+
+        :param use_sequence  If True, allocate seqs from a Postgres SEQUENCE
+            (see sequence_name) instead of updating the datastore's row in
+            data_sync_revisions, which makes concurrent writers wait for each
+            other until they commit.  Writes must be in a transaction with the
+            docs they write.  Once on, leave it on: data_sync_revisions is not
+            updated any more.
+        :param bulk_load_min_docs  put_many loads at least this many docs with
+            COPY and one merge, instead of a put per doc.  None to never.
+        """
+        super().__init__(
+            datastore_name,
+            conn,
+            tablename,
+            datastore_id,
+            metadata_cache=metadata_cache,
+            cache_key=cache_key,
+            track_peers=track_peers,
+        )
         self.placeholder = "%s"
+        self.use_sequence = use_sequence
+        self.sequence_name = self.get_sequence_name(datastore_name)
+        self.bulk_load_min_docs = bulk_load_min_docs
+
+    def _begin(self) -> None:
+        # psycopg2 starts one itself, unless in autocommit mode
+        if self.conn.autocommit:
+            self.cursor.execute("BEGIN")
+
+    def _commit(self) -> None:
+        if self.conn.autocommit:
+            self.cursor.execute("COMMIT")
+        else:
+            self.conn.commit()
+
+    def _rollback(self) -> None:
+        if self.conn.autocommit:
+            self.cursor.execute("ROLLBACK")
+        else:
+            self.conn.rollback()
+
+    @staticmethod
+    def get_sequence_name(datastore_name: str) -> str:
+        """Return the name of the SEQUENCE for datastore_name if use_sequence."""
+        slug = re.sub(r"\W", "_", datastore_name.lower())[:30]
+        return f"data_sync_seq_{slug}_{util.dict_hash(datastore_name)[:8]}"
+
+    @staticmethod
+    def read_sequence_id(
+        cursor, datastore_name: str, use_sequence: bool = False
+    ) -> Optional[tuple[str, int]]:
+        """Return (datastore id, sequence id) of datastore_name, or None.
+
+        With use_sequence, all docs with _seq <= the sequence id returned are
+        committed (or rolled back).  Writers hold a shared advisory lock from
+        nextval until they commit, so we wait for them with an exclusive one.
+        New writers wait for us, but only for these few statements.
+        """
+        if not use_sequence:
+            cursor.execute(
+                "SELECT datastore_id, sequence_id FROM data_sync_revisions"
+                " WHERE datastore_name=%s",
+                (datastore_name,),
+            )
+            return cursor.fetchone()
+
+        sequence_name = PostgresDatastore.get_sequence_name(datastore_name)
+        cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (sequence_name,))
+        try:
+            # The sequence starts after sequence_id, see _init_datastore_id
+            cursor.execute(
+                "SELECT datastore_id, GREATEST(sequence_id,"
+                "  COALESCE(pg_sequence_last_value(to_regclass(%s)), 0))"
+                " FROM data_sync_revisions WHERE datastore_name=%s",
+                (sequence_name, datastore_name),
+            )
+            return cursor.fetchone()
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (sequence_name,))
+
+    def _sequence_id_sql(self) -> str:
+        if not self.use_sequence:
+            return super()._sequence_id_sql()
+        # The last seq handed out, maybe not committed yet.  That's fine for
+        # new revs, and get_docs_since reads one that is safe to report.
+        return (
+            "GREATEST(sequence_id, COALESCE("
+            f"pg_sequence_last_value(to_regclass('{self.sequence_name}')), 0))"
+        )
+
+    def _init_datastore_id(self):
+        super()._init_datastore_id()
+        if self.use_sequence:
+            # Start after the seqs data_sync_revisions handed out.
+            # This is in the caller's transaction, so if that rolls back, so
+            # does the CREATE, and the next __enter__ tries again.
+            self.cursor.execute(
+                f"CREATE SEQUENCE IF NOT EXISTS {self.sequence_name}"
+                f" START WITH {int(self._sequence_id) + 1}"
+            )
+
+    def _nextvals(self, num: int) -> list[int]:
+        """Get num seqs from the sequence, holding the writers' lock until commit."""
+        self._check_cursor()
+        # OFFSET 0 keeps the lock in a subquery, which runs before any nextval
+        self.cursor.execute(
+            "SELECT nextval(%s)"
+            " FROM (SELECT pg_advisory_xact_lock_shared(hashtext(%s)) OFFSET 0)"
+            " AS writers, generate_series(1, %s)",
+            (self.sequence_name, self.sequence_name, num),
+        )
+        seqs = sorted(row[0] for row in self.cursor.fetchall())
+        self._sequence_id = max(self._sequence_id, seqs[-1])
+        logger.debug(f"{self.id}: got seqs {seqs[0]}..{seqs[-1]} from sequence")
+        return seqs
+
+    def _refresh_sequence_id(self) -> None:
+        """Set the sequence id to one that is safe to report.
+
+        It may be lower than the last seq we handed out, if other writers
+        are still in flight, see read_sequence_id.
+        """
+        _, self._sequence_id = self.read_sequence_id(
+            self.cursor, self.name, use_sequence=True
+        )
 
     # def _set_sequence_id(self, the_id) -> None:
     #     # The RETURNING syntax has been supported by Postgres at least
@@ -604,6 +1382,8 @@ class PostgresDatastore(DatabaseDatastore):
     #     ), f"seq_id {self._sequence_id} DB seq_id {new_val}"
 
     def _increment_sequence_id(self) -> int:
+        if self.use_sequence:
+            return self._nextvals(1)[0]
         self._check_cursor()
         self.cursor.execute(
             "UPDATE data_sync_revisions set sequence_id = sequence_id+1"
@@ -612,12 +1392,142 @@ class PostgresDatastore(DatabaseDatastore):
             (self.id,),
         )
         new_val = self.cursor.fetchone()[0]
-        self._sequence_id += 1
-        assert (
-            self._sequence_id == new_val
-        ), f"seq_id {self._sequence_id} DB seq_id {new_val}"
+        # Not just self._sequence_id + 1: other connections may have written
+        # since we read it.  The row lock keeps them out until we commit.
+        self._sequence_id = new_val
         return new_val
 
+    def _reserve_sequence_ids(self, num: int) -> Sequence[int]:
+        if self.use_sequence:
+            return self._nextvals(num)
+        self._check_cursor()
+        self.cursor.execute(
+            "UPDATE data_sync_revisions set sequence_id = sequence_id+%s"
+            " WHERE datastore_id=%s"
+            " RETURNING sequence_id",
+            (num, self.id),
+        )
+        new_val = self.cursor.fetchone()[0]
+        self._sequence_id = new_val
+        return range(new_val - num + 1, new_val + 1)
+
+    def put_many(self, docs: Sequence[Document]) -> int:
+        # copy_expert is psycopg2's, which Django's cursor passes through
+        if (
+            self.bulk_load_min_docs is None
+            or len(docs) < self.bulk_load_min_docs
+            or not hasattr(self.cursor, "copy_expert")
+        ):
+            return super().put_many(docs)
+        return self._bulk_load(docs)
+
+    def _bulk_load(self, docs: Sequence[Document]) -> int:
+        """put_many with COPY into a staging table, and one merge from it.
+
+        Which docs to put is decided as in put(), against the revs of the rows
+        we have, which are locked until commit.
+        """
+        self._check_cursor()
+        # We need the whole rows to see what changed, for _DELTA
+        columns = "*" if self.track_deltas else "_id, _rev"
+        self.cursor.execute(
+            f"SELECT {columns} FROM {self.tablename}" " WHERE _id = ANY(%s) FOR UPDATE",
+            ([doc[_ID] for doc in docs],),
+        )
+        my_docs = {}
+        if self.track_deltas:
+            my_docs = {
+                doc[_ID]: doc
+                for doc in (self._row_to_doc(row) for row in self.cursor.fetchall())
+            }
+            my_revs = {
+                docid: VectorClock.from_string(doc[_REV])
+                for docid, doc in my_docs.items()
+            }
+        else:
+            my_revs = {
+                docid: VectorClock.from_string(rev)
+                for docid, rev in self.cursor.fetchall()
+            }
+        purged_seq = self.get_purged_sequence_id()
+
+        # docid -> doc to put
+        to_put = {}
+        for doc in docs:
+            if _REV not in doc:
+                raise ValueError(f"doc {doc.get(_ID, '')} must have {_REV}")
+            if _BASE_REV in doc:
+                raise ValueError(f"doc {doc[_ID]} is a patch, use put_deltas")
+            try:
+                rev = VectorClock.from_string(doc[_REV])
+            except ValueError as err:
+                raise ValueError(f"{_REV} must be a JSON dictionary: {err}")
+            docid = doc[_ID]
+            my_rev = my_revs.get(docid, None)
+            if (
+                my_rev is None
+                and doc.get(_DELETED, False)
+                and 0 < rev.get_clock(self.id, 0) <= purged_seq
+            ):
+                # Don't bring back a tombstone we purged, see _was_purged
+                continue
+            if my_rev is None or my_rev < rev:
+                my_revs[docid] = rev
+                to_put[docid] = doc
+        if not to_put:
+            return 0
+
+        rows = io.StringIO()
+        for doc, seq_id in zip(
+            to_put.values(), self._reserve_sequence_ids(len(to_put))
+        ):
+            doc = doc.copy()
+            doc[_SEQ] = seq_id
+            self._set_delta(doc, my_docs.get(doc[_ID], None))
+            rows.write(
+                "\t".join(self._copy_value(doc.get(col)) for col in self.columnnames)
+            )
+            rows.write("\n")
+        rows.seek(0)
+
+        # Temp tables are per connection, so concurrent loads don't collide.
+        # The name changes with the columns, in case the table changes.
+        staging = f"rds_load_{util.dict_hash([self.tablename, self.columnnames])[:12]}"
+        col_names = ",".join(self.columnnames)
+        set_statement = ", ".join(f"{col}=EXCLUDED.{col}" for col in self.columnnames)
+        self.cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {self.tablename})"
+        )
+        self.cursor.execute(f"TRUNCATE {staging}")
+        self.cursor.copy_expert(f"COPY {staging} ({col_names}) FROM STDIN", rows)
+        self.cursor.execute(
+            f"INSERT INTO {self.tablename} ({col_names})"
+            f" SELECT {col_names} FROM {staging}"
+            f" ON CONFLICT (_id) DO UPDATE SET {set_statement}"
+        )
+        logger.debug(
+            f"{self.id}: Bulk loaded {len(to_put)} of {len(docs)} docs"
+            f" into {self.tablename}"
+        )
+        return len(to_put)
+
+    @staticmethod
+    def _copy_value(value) -> str:
+        """Return value in COPY's text format."""
+        if value is None:
+            return "\\N"
+        if isinstance(value, bool):
+            return "t" if value else "f"
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+
     def get(self, docid: ID_TYPE, include_deleted=False) -> Document:
         """Return doc, or None if not present."""
         doc = None
@@ -635,34 +1545,256 @@ class PostgresDatastore(DatabaseDatastore):
                 doc = None
         return doc
 
-    def get_docs_since(self, the_seq: int, num: int) -> tuple[int, Sequence[Document]]:
+    def get_docs_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
         """Get docs put with the_seq < seq <= (the_seq+num).
 
         This is intended to be called repeatedly to get them all, so as to
         allow syncing in chunks.
         """
         self._check_cursor()
+        if self.use_sequence:
+            # Before reading docs, so the docs up to it are all there
+            self._refresh_sequence_id()
+        where_sql, where_params = self._where_sql(where)
         self.cursor.execute(
             f"SELECT * FROM {self.tablename} "
-            "WHERE %s < _seq AND _seq <= %s ORDER BY _seq",
-            (the_seq, the_seq + num),
+            f"WHERE %s < _seq AND _seq <= %s{where_sql} ORDER BY _seq",
+            (the_seq, the_seq + num, *where_params),
         )
         docs = [self._row_to_doc(docrow) for docrow in self.cursor.fetchall()]
         return self.sequence_id, docs
 
 
+class MultiTableDatastore(Datastore):
+    """Several tables as one datastore, with one sequence and change stream.
+
+    Docs from get_docs_since are tagged with their table in _TABLE, and docs
+    to put must have it.
+
+    The tables' datastores must share a sequence and peer state: database
+    datastores with the same name, on the same connection.
+    """
+
+    def __init__(self, datastores: dict[str, Datastore]):
+        """Init a multi-table datastore.
+
+        :param datastores  Datastore of each table, by the name to tag docs with
+        """
+        if not datastores:
+            raise ValueError("MultiTableDatastore needs at least one table")
+        names = {datastore.name for datastore in datastores.values()}
+        if len(names) != 1:
+            raise ValueError(f"Tables must be in one datastore, not {names}")
+        self.datastores = datastores
+        # Peer state is shared, so we keep it in the first one
+        self._first = next(iter(datastores.values()))
+        super().__init__(self._first.name, self._first.id)
+
+    def __enter__(self):
+        super().__enter__()
+        with contextlib.ExitStack() as stack:
+            for datastore in self.datastores.values():
+                stack.enter_context(datastore)
+            ids = {datastore.id for datastore in self.datastores.values()}
+            if len(ids) != 1:
+                raise ValueError(f"Tables must share a datastore id, not {ids}")
+            self.id = self._first.id
+            self._sync_sequence_ids()
+            # Entered them all, so don't exit them now
+            stack.pop_all()
+        return self
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        for datastore in self.datastores.values():
+            datastore.__exit__(*args)
+
+    def _sync_sequence_ids(self) -> None:
+        """Tell every table about the latest sequence id any of them saw."""
+        self._sequence_id = max(
+            datastore.sequence_id for datastore in self.datastores.values()
+        )
+        for datastore in self.datastores.values():
+            # pylint: disable-next=protected-access
+            datastore._set_sequence_id(self._sequence_id)
+
+    def _get_datastore(self, table: str) -> Datastore:
+        datastore = self.datastores.get(table, None)
+        if datastore is None:
+            raise ValueError(f"Unknown table '{table}'")
+        return datastore
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # They share a connection, so one transaction covers them all
+        old_sequence_ids = {
+            table: datastore.sequence_id for table, datastore in self.datastores.items()
+        }
+        try:
+            with self._first.transaction():
+                yield
+        except BaseException:
+            for table, datastore in self.datastores.items():
+                # pylint: disable-next=protected-access
+                datastore._sequence_id = old_sequence_ids[table]
+            self._sequence_id = max(old_sequence_ids.values())
+            raise
+
+    def _put(self, doc: Document):
+        # We re-implemented put(), so we don't need _put()
+        raise NotImplementedError("Not implemented")
+
+    def _untag(self, doc: Document) -> tuple[str, Document]:
+        if _TABLE not in doc:
+            raise ValueError(f"doc {doc.get(_ID, '')} must have {_TABLE}")
+        doc = doc.copy()
+        return doc.pop(_TABLE), doc
+
+    def put(self, doc: Document, increment_rev=False) -> tuple[int, Document]:
+        table, doc = self._untag(doc)
+        num, new_doc = self._get_datastore(table).put(doc, increment_rev)
+        self._sync_sequence_ids()
+        new_doc = new_doc.copy()
+        new_doc[_TABLE] = table
+        return num, new_doc
+
+    def _runs(self, docs: Sequence[Document]) -> Iterator[tuple[str, list]]:
+        """Yield (table, untagged docs) for runs of docs of the same table."""
+        run_table, run = None, []
+        for doc in docs:
+            table, doc = self._untag(doc)
+            if run and table != run_table:
+                yield run_table, run
+                run = []
+            run_table = table
+            run.append(doc)
+        if run:
+            yield run_table, run
+
+    def put_many(self, docs: Sequence[Document]) -> int:
+        # Put runs of docs for the same table together, keeping their order
+        num_put = 0
+        for table, run in self._runs(docs):
+            num_put += self._get_datastore(table).put_many(run)
+            self._sync_sequence_ids()
+        return num_put
+
+    def put_deltas(self, docs: Sequence[Document]) -> tuple[int, list[int]]:
+        num_put = 0
+        missing_seqs = []
+        for table, run in self._runs(docs):
+            num, missing = self._get_datastore(table).put_deltas(run)
+            num_put += num
+            missing_seqs.extend(missing)
+            self._sync_sequence_ids()
+        return num_put, missing_seqs
+
+    def get(self, docid: ID_TYPE, include_deleted=False) -> Document:
+        """Return doc, or None if not present.
+
+        :param docid  (table, doc id)
+        """
+        table, the_id = docid
+        doc = self._get_datastore(table).get(the_id, include_deleted)
+        if doc is not None:
+            doc[_TABLE] = table
+        return doc
+
+    def delete(self, docid: ID_TYPE) -> None:
+        """Delete a doc.
+
+        :param docid  (table, doc id)
+        """
+        table, the_id = docid
+        self._get_datastore(table).delete(the_id)
+        self._sync_sequence_ids()
+
+    def get_docs_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
+        """Get docs of all tables put with the_seq < seq <= (the_seq+num).
+
+        :param where  where (see Datastore.get_docs_since) of each table, by
+            table.  Tables not in it aren't filtered.
+        """
+        where = where or {}
+        for table, table_where in where.items():
+            self._get_datastore(table)
+            if not isinstance(table_where, dict):
+                raise ValueError(f"where of table '{table}' must be a dict")
+        seqs = []
+        docs = []
+        for table, datastore in self.datastores.items():
+            seq, table_docs = datastore.get_docs_since(
+                the_seq, num, where.get(table, None)
+            )
+            seqs.append(seq)
+            for doc in table_docs:
+                doc[_TABLE] = table
+                docs.append(doc)
+        docs.sort(key=lambda doc: doc[_SEQ])
+        # A table read later may report a later sequence id, but docs of
+        # tables read before it may have been written since
+        return min(seqs), docs
+
+    def get_peer_sequence_id(self, peer: str) -> int:
+        return self._first.get_peer_sequence_id(peer)
+
+    def set_peer_sequence_id(self, peer: str, seq: int) -> None:
+        self._first.set_peer_sequence_id(peer, seq)
+
+    def ack_peer_sequence_id(self, peer: str, seq: int) -> None:
+        self._first.ack_peer_sequence_id(peer, seq)
+
+    def forget_peer(self, peer: str) -> None:
+        self._first.forget_peer(peer)
+
+    def get_peer_acks(self) -> dict[str, int]:
+        return self._first.get_peer_acks()
+
+    def get_purged_sequence_id(self) -> int:
+        return self._first.get_purged_sequence_id()
+
+    def _set_purged_sequence_id(self, seq: int) -> None:
+        # pylint: disable-next=protected-access
+        self._first._set_purged_sequence_id(seq)
+
+    def _purge_tombstones(self, the_seq: int) -> int:
+        # pylint: disable-next=protected-access
+        return sum(ds._purge_tombstones(the_seq) for ds in self.datastores.values())
+
+
 class RestClientSourceDatastore(Datastore):
     """Communicate to a REST server for a datastore."""
 
-    def __init__(self, baseurl: str, datastore_name: str):
+    def __init__(
+        self,
+        baseurl: str,
+        datastore_name: str,
+        peer_id: Optional[str] = None,
+        where: Optional[dict] = None,
+    ):
         """Init a datastore.
 
         :param baseurl: The base URL of the REST server
         :param datastore_name:  Human-readable name
+        :param peer_id:  Id of the datastore pulling from this one.  If given,
+                         the server keeps tombstones until that peer has them.
+                         Only give a peer id that persists between syncs.
+        :param where:  If given, the server only sends docs with these field
+                       values (see Datastore.get_docs_since), for pulls and
+                       snapshots.
         """
         super().__init__(datastore_name)
         self.datastore_name = datastore_name
         self.baseurl = baseurl
+        self.peer_id = peer_id
+        self.where = where
+        # (params, ETag, result) of the last get_docs_since, to send in
+        # If-None-Match so an unchanged chunk comes back as 304 Not Modified
+        self._last_docs = None
 
     def get(self, docid: ID_TYPE, include_deleted=False) -> Document:
         resp = requests.get(
@@ -689,28 +1821,153 @@ class RestClientSourceDatastore(Datastore):
             json=doc,
         )
         assert resp.status_code == 200, resp.status_code
-        json = resp.json()
-        return json["num_docs_put"], json["document"]
+        js = resp.json()
+        return js["num_docs_put"], js["document"]
+
+    def put_many(self, docs: Sequence[Document]) -> int:
+        """Put docs in one request."""
+        if not docs:
+            return 0
+        resp = requests.post(self._server_url(self.datastore_name + "/docs"), json=docs)
+        if resp.status_code == 422:
+            raise ValueError(resp.content.decode("utf-8"))
+        assert resp.status_code == 200, resp.status_code
+        return resp.json()["num_docs_put"]
+
+    def put_deltas(self, docs: Sequence[Document]) -> tuple[int, list[int]]:
+        """Put docs and patches in one request, the server applies them."""
+        if not docs:
+            return 0, []
+        resp = requests.post(
+            self._server_url(self.datastore_name + "/docs"),
+            params={"deltas": "true"},
+            json=docs,
+        )
+        if resp.status_code == 422:
+            raise ValueError(resp.content.decode("utf-8"))
+        assert resp.status_code == 200, resp.status_code
+        js = resp.json()
+        return js["num_docs_put"], js["missing_seqs"]
+
+    def _where_param(self, where: Optional[dict]) -> dict:
+        """Return the query parameter for where, or for self.where if None."""
+        where = self.where if where is None else where
+        return {"where": json.dumps(where)} if where else {}
 
     # TODO: Unit test that deleted docs are included
-    def get_docs_since(self, the_seq: int, num: int) -> tuple[int, Sequence[Document]]:
+    def get_docs_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
+        return self._get_docs(the_seq, num, where, deltas=False)
+
+    def get_deltas_since(
+        self, the_seq: int, num: int, where: Optional[dict] = None
+    ) -> tuple[int, Sequence[Document]]:
+        return self._get_docs(the_seq, num, where, deltas=True)
+
+    def _get_docs(
+        self, the_seq: int, num: int, where: Optional[dict], deltas: bool
+    ) -> tuple[int, Sequence[Document]]:
         the_url = self._server_url(self.datastore_name + "/docs")
-        resp = requests.get(
-            the_url,
-            params={"start_sequence_id": the_seq, "chunk_size": num},
-        )
+        params = {"start_sequence_id": the_seq, "chunk_size": num}
+        if self.peer_id:
+            params["peer_id"] = self.peer_id
+        params.update(self._where_param(where))
+        if deltas:
+            params["deltas"] = "true"
+        headers = {}
+        if self._last_docs and self._last_docs[0] == params:
+            headers["If-None-Match"] = self._last_docs[1]
+        resp = requests.get(the_url, params=params, headers=headers)
         ret = None
         # TODO: What about 500?
-        if resp.status_code == 200:
+        if resp.status_code == 304:
+            # Nothing changed since the last time we asked
+            ret = self._last_docs[2]
+        elif resp.status_code == 200:
             js = resp.json()
             ret = (
                 js["current_sequence_id"],
                 [Document(doc) for doc in js["documents"]],
             )
-        elif resp.status_code in (403, 404):
+            etag = resp.headers.get("ETag")
+            self._last_docs = (params, etag, ret) if etag else None
+        elif resp.status_code == 410:
+            # The server purged tombstones we haven't seen
+            raise ResyncRequired(resp.content.decode("utf-8"))
+        elif resp.status_code in (403, 404, 422):
             content = resp.content.decode("utf-8")
             raise ValueError(f"{resp.url} returned HTTP {resp.status_code}: {content}")
         return ret
 
+    def write_snapshot(
+        self, fileobj, chunk_size: int = 1000, where: Optional[dict] = None
+    ) -> int:
+        """Download a snapshot from the server.
+
+        If peer_id is set, the server keeps tombstones from the snapshot's
+        sequence id on for that peer.
+        """
+        params = {"chunk_size": chunk_size}
+        if self.peer_id:
+            params["peer_id"] = self.peer_id
+        params.update(self._where_param(where))
+        with requests.get(
+            self._server_url(self.datastore_name + "/snapshot"),
+            params=params,
+            stream=True,
+        ) as resp:
+            if resp.status_code != 200:
+                content = resp.content.decode("utf-8")
+                raise ValueError(
+                    f"{resp.url} returned HTTP {resp.status_code}: {content}"
+                )
+            for block in resp.iter_content(chunk_size=65536):
+                fileobj.write(block)
+            return int(resp.headers["X-Sequence-Id"])
+
+    def check_peer_sequence_id(self, seq: int) -> None:
+        """Ask the server, since only it knows what it purged."""
+        if self.peer_id:
+            # the server raises 410 for an empty chunk, too
+            self.get_docs_since(seq, 0)
+
+    def wait_for_changes(self, the_seq: int, timeout: float = 30) -> int:
+        """Long-poll until the server's sequence id passes the_seq, or timeout.
+
+        :return the server's current sequence id, <= the_seq if nothing changed
+        """
+        resp = requests.get(
+            self._server_url(self.datastore_name + "/changes"),
+            params={"start_sequence_id": the_seq, "timeout": timeout},
+            # allow the server its whole timeout, and then some
+            timeout=timeout + 30,
+        )
+        if resp.status_code != 200:
+            content = resp.content.decode("utf-8")
+            raise ValueError(f"{resp.url} returned HTTP {resp.status_code}: {content}")
+        return resp.json()["current_sequence_id"]
+
+    def stream_changes(self, the_seq: int, timeout: float = 300) -> Iterator[int]:
+        """Yield the server's sequence id each time it passes the_seq.
+
+        This reads the server-sent events stream, which ends after timeout.
+        """
+        with requests.get(
+            self._server_url(self.datastore_name + "/changes/stream"),
+            params={"start_sequence_id": the_seq, "timeout": timeout},
+            stream=True,
+            timeout=timeout + 30,
+        ) as resp:
+            if resp.status_code != 200:
+                content = resp.content.decode("utf-8")
+                raise ValueError(
+                    f"{resp.url} returned HTTP {resp.status_code}: {content}"
+                )
+            for line in resp.iter_lines(decode_unicode=True):
+                # ignore other SSE fields, and ": keepalive" comments
+                if line.startswith("data:"):
+                    yield json.loads(line[len("data:") :])["current_sequence_id"]
+
     def _server_url(self, url: str) -> str:
         return self.baseurl + url
@@ -8,6 +8,12 @@ _SEQ = "_seq"
 _ID = "_id"
 # _DELETED is True if the doc has been deleted
 _DELETED = "_deleted"
+# _TABLE is the table of a doc from a MultiTableDatastore
+_TABLE = "_table"
+# _DELTA says which fields the doc's last put changed, see track_deltas
+_DELTA = "_delta"
+# _BASE_REV is the rev a patch applies to, see Datastore.get_deltas_since
+_BASE_REV = "_base_rev"
 
 ID_TYPE = TypeVar("ID_TYPE")
 
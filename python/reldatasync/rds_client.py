@@ -11,11 +11,13 @@ import sqlite3
 from reldatasync import util
 from reldatasync.datastore import (
     MemoryDatastore,
+    MultiTableDatastore,
+    ResyncRequired,
     RestClientSourceDatastore,
     SqliteDatastore,
 )
 from reldatasync.document import _SEQ
-from reldatasync.replicator import Replicator
+from reldatasync.replicator import ReplicationError, Replicator
 
 
 def main():
@@ -37,9 +39,30 @@ def main():
         "--tables", nargs="+", required=True, help="List of table names to sync"
     )
     parser.add_argument("--local-datastore-name", default="client", help="Datastore id")
+    parser.add_argument(
+        "--single-stream",
+        action="store_true",
+        help="Sync all tables in one stream (see MultiTableDatastore)."
+        "  Needs --sqlite-file, and --tables must have all the server's tables.",
+    )
+    parser.add_argument(
+        "--snapshot-min-lag",
+        type=int,
+        help="If this many sequence ids behind the server, load a snapshot"
+        " instead of pulling all the changes",
+    )
+    parser.add_argument(
+        "--where",
+        help="Only pull docs with these column values, as a JSON object,"
+        ' e.g. \'{"org_id": "X"}\'.  With --single-stream, by table.',
+    )
 
     args = parser.parse_args()
     util.logging_basic_config(level=args.log_level)
+    try:
+        where = util.parse_where(args.where)
+    except ValueError as err:
+        parser.error(str(err))
 
     sqlite_conn = (
         sqlite3.connect(
@@ -51,16 +74,60 @@ def main():
         else None
     )
 
-    for table in args.tables:
-        remote_datastore_name = args.remote_datastore_name + "/" + table
-        remote_ds = RestClientSourceDatastore(args.server_url, remote_datastore_name)
+    if args.single_stream:
+        if not sqlite_conn:
+            parser.error("--single-stream needs --sqlite-file")
+        # One datastore for all tables, synced with the server's datastore
+        syncs = [
+            (
+                "all tables",
+                MultiTableDatastore(
+                    {
+                        table: SqliteDatastore(
+                            args.local_datastore_name, sqlite_conn, table
+                        )
+                        for table in args.tables
+                    }
+                ),
+                args.remote_datastore_name,
+            )
+        ]
+    else:
+        syncs = [
+            (
+                f"table {table}",
+                (
+                    SqliteDatastore(args.local_datastore_name, sqlite_conn, table)
+                    if sqlite_conn
+                    else MemoryDatastore("client")
+                ),
+                args.remote_datastore_name + "/" + table,
+            )
+            for table in args.tables
+        ]
 
-        # Put docs in a local datastore
-        ds = MemoryDatastore("client")
-        if args.sqlite_file:
-            ds = SqliteDatastore(args.local_datastore_name, sqlite_conn, table)
+    for what, ds, remote_datastore_name in syncs:
+        remote_ds = RestClientSourceDatastore(
+            args.server_url, remote_datastore_name, where=where
+        )
         with ds:
-            Replicator(ds, remote_ds).sync_both_directions()
+            if args.sqlite_file:
+                # Our id persists, so the server can keep tombstones for us
+                remote_ds.peer_id = ds.id
+            try:
+                # Commit each chunk, instead of each statement
+                Replicator(
+                    ds,
+                    remote_ds,
+                    snapshot_min_lag=args.snapshot_min_lag,
+                    chunk_transactions=True,
+                ).sync_both_directions()
+            except ResyncRequired as err:
+                raise SystemExit(
+                    f"{what} needs a full resync, clear it and sync again: {err}"
+                ) from err
+            except ReplicationError as err:
+                raise SystemExit(f"{what} sync stopped: {err}") from err
 
         if args.print_results:
             # Write out the results
@@ -76,7 +143,7 @@ def main():
                 if not docs:
                     done = True
 
-        print(f"Local datastore has sequence id {ds.sequence_id} for table {table}")
+        print(f"Local datastore has sequence id {ds.sequence_id} for {what}")
 
 
 if __name__ == "__main__":
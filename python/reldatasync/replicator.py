@@ -1,31 +1,140 @@
+import contextlib
+import functools
 import logging
+import tempfile
+from typing import Optional
 
 from reldatasync.datastore import Datastore
+from reldatasync.document import _ID, _SEQ, Document
 
 logger = logging.getLogger(__name__)
 
 
+class ReplicationError(Exception):
+    """A doc could not be put.  Docs before it were put, and committed."""
+
+
 class Replicator:
-    def __init__(self, source: Datastore, destination: Datastore, chunk_size: int = 10):
+    def __init__(
+        self,
+        source: Datastore,
+        destination: Datastore,
+        chunk_size: int = 10,
+        snapshot_min_lag: Optional[int] = None,
+        chunk_transactions: bool = False,
+        deltas: bool = False,
+    ):
         """Replicate from source to destination (with pull), or both ways.
 
         :param source:   Source of data (for pull)
         :param destination:   Destination for data (for pull)
         :param chunk_size  Approximate number of docs per chunk
+        :param snapshot_min_lag  If the side we pull from is at least this many
+            seqs ahead of what we have, load a snapshot of it (see
+            Datastore.write_snapshot) instead of pulling every chunk.
+            None to never.
+        :param chunk_transactions  If True, put each chunk in one transaction
+            (see Datastore.transaction), with how far we pulled, and commit
+            it.  If a doc fails, keep the docs before it, and raise
+            ReplicationError.  The next pull tries from that doc again.
+        :param deltas  If True, pull only the fields that changed in docs
+            where we can (see Datastore.get_deltas_since), instead of whole
+            docs.
         """
         self.source = source
         self.destination = destination
         self.chunk_size = chunk_size
+        self.snapshot_min_lag = snapshot_min_lag
+        self.chunk_transactions = chunk_transactions
+        self.deltas = deltas
+
+    @staticmethod
+    def _load_snapshot(destination, source) -> tuple[int, int]:
+        """Load a snapshot of source into destination.
+
+        :return sequence id of the snapshot, number of docs changed
+        """
+        with tempfile.TemporaryFile() as snapshot:
+            source.write_snapshot(snapshot)
+            snapshot.seek(0)
+            return destination.load_snapshot(snapshot)
+
+    @staticmethod
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def _put_docs(destination, source, docs, the_seq, chunk_size, deltas) -> int:
+        """Put docs of source's chunk after the_seq in destination.
+
+        With deltas, docs may be patches, and for patches destination can't
+        apply, we get the chunk's whole docs.
+        """
+        if not deltas:
+            return destination.put_many(docs)
+        num_put, missing_seqs = destination.put_deltas(docs)
+        if missing_seqs:
+            logger.debug(
+                f"{destination.id}: can't apply {len(missing_seqs)} patches"
+                f" from {source.id}, get whole docs"
+            )
+            missing_seqs = set(missing_seqs)
+            _, whole_docs = source.get_docs_since(the_seq, chunk_size)
+            # A doc changed since is in a later chunk
+            num_put += destination.put_many(
+                [doc for doc in whole_docs if doc[_SEQ] in missing_seqs]
+            )
+        return num_put
 
     @staticmethod
-    def _pull_changes(destination, source, chunk_size) -> int:
+    def _put_chunk(
+        destination, docs, put_docs
+    ) -> tuple[int, Optional[tuple[Document, Exception]]]:
+        """Put docs in a savepoint, or if that fails, one at a time up to the
+        first one that fails.
+
+        :param put_docs  Function to put a list of docs with, see _put_docs
+        :return number of docs put, and (doc, error) for a doc that failed
+        """
+        try:
+            with destination.transaction():
+                return put_docs(docs), None
+        # Datastores raise ValueError, and database errors depend on the driver
+        # pylint: disable-next=broad-exception-caught
+        except Exception as err:
+            logger.warning(
+                f"{destination.id}: chunk failed, put docs one by one: {err}"
+            )
+        num_put = 0
+        for doc in docs:
+            try:
+                with destination.transaction():
+                    num_put += put_docs([doc])
+            # pylint: disable-next=broad-exception-caught
+            except Exception as err:
+                return num_put, (doc, err)
+        return num_put, None
+
+    @staticmethod
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def _pull_changes(
+        destination,
+        source,
+        chunk_size,
+        snapshot_min_lag=None,
+        chunk_transactions=False,
+        deltas=False,
+    ) -> int:
         """Pull changes from source to destination.
 
-        Also update destination seq id, and destination peer seq id.
+        Also update destination seq id, and destination peer seq id, and
+        tell source how far destination has pulled (see purge_tombstones).
+
+        Raise ResyncRequired if source purged tombstones destination hasn't seen.
 
         :param destination  Where changes end up
         :param source  Where changes come from
         :param chunk_size Approximate chunk size to use during operation
+        :param snapshot_min_lag  See __init__
+        :param chunk_transactions  See __init__
+        :param deltas  See __init__
 
         :return: number of docs changed on destination
         """
@@ -33,15 +142,64 @@ class Replicator:
         # since we last synced
         docs_changed = 0
         old_peer_seq_id = destination.get_peer_sequence_id(source.id)
+        source.check_peer_sequence_id(old_peer_seq_id)
         new_peer_seq_id = old_peer_seq_id
+        get_docs_since = source.get_deltas_since if deltas else source.get_docs_since
         # get docs in chunks of approximately chunk_size
         source_seq_id = None
         # Move forward in chunks of chunk_size, but only to source_seq_id
         while source_seq_id is None or source_seq_id > new_peer_seq_id:
-            source_seq_id, docs = source.get_docs_since(new_peer_seq_id, chunk_size)
-            for doc in docs:
-                num, _new_doc = destination.put(doc)
+            source_seq_id, docs = get_docs_since(new_peer_seq_id, chunk_size)
+            if snapshot_min_lag and source_seq_id - new_peer_seq_id >= snapshot_min_lag:
+                # Far behind, so skip replaying the history.  The snapshot
+                # has these docs too.
+                logger.debug(
+                    f"{destination.id} is {source_seq_id - new_peer_seq_id}"
+                    f" behind {source.id}, load a snapshot"
+                )
+                with (
+                    destination.transaction()
+                    if chunk_transactions
+                    else contextlib.nullcontext()
+                ):
+                    new_peer_seq_id, num = Replicator._load_snapshot(
+                        destination, source
+                    )
+                    destination.set_peer_sequence_id(source.id, new_peer_seq_id)
                 docs_changed += num
+                snapshot_min_lag = None
+                # Changes since the snapshot wait for the next pull
+                source_seq_id = new_peer_seq_id
+                continue
+            put_docs = functools.partial(
+                Replicator._put_docs,
+                destination,
+                source,
+                the_seq=new_peer_seq_id,
+                chunk_size=chunk_size,
+                deltas=deltas,
+            )
+            if chunk_transactions:
+                with destination.transaction():
+                    num, failed = Replicator._put_chunk(destination, docs, put_docs)
+                    docs_changed += num
+                    # Commit how far we got with the docs
+                    destination.set_peer_sequence_id(
+                        source.id,
+                        (
+                            failed[0][_SEQ] - 1
+                            if failed
+                            else min(source_seq_id, new_peer_seq_id + chunk_size)
+                        ),
+                    )
+                if failed:
+                    doc, err = failed
+                    raise ReplicationError(
+                        f"{destination.id} could not put doc {doc.get(_ID)}"
+                        f" from {source.id}: {err}"
+                    ) from err
+            else:
+                docs_changed += put_docs(docs)
 
             # This used to be true, but now it's not.  If the destination
             # ignores some things, then its sequence_id may not rise.
@@ -65,12 +223,20 @@ class Replicator:
 
         # we've got up to new_peer_seq_id, so dest must be >= that
         destination.set_peer_sequence_id(source.id, new_peer_seq_id)
+        source.ack_peer_sequence_id(destination.id, new_peer_seq_id)
 
         return docs_changed
 
     def _push_changes(self) -> int:
         """Push changes from destination to source."""
-        return Replicator._pull_changes(self.destination, self.source, self.chunk_size)
+        return Replicator._pull_changes(
+            self.destination,
+            self.source,
+            self.chunk_size,
+            self.snapshot_min_lag,
+            self.chunk_transactions,
+            self.deltas,
+        )
 
     def pull_changes(self) -> int:
         """Pull changes from source to destination.
@@ -79,7 +245,14 @@ class Replicator:
 
         :return: number of docs changed (in self).
         """
-        return Replicator._pull_changes(self.source, self.destination, self.chunk_size)
+        return Replicator._pull_changes(
+            self.source,
+            self.destination,
+            self.chunk_size,
+            self.snapshot_min_lag,
+            self.chunk_transactions,
+            self.deltas,
+        )
 
     def sync_both_directions(self) -> None:
         """Sync client and server in both directions
@@ -107,6 +280,12 @@ class Replicator:
         #   source: 3* ---> dest  : 3*
         #   dest  : 3*      source: 3*
 
+        # Pushing docs whose tombstones destination purged would bring them
+        # back, so first make sure we haven't missed any
+        self.destination.check_peer_sequence_id(
+            self.source.get_peer_sequence_id(self.destination.id)
+        )
+
         # 1. source -> destination
         logger.debug(
             f"******* push changes from {self.source.id}" f" to {self.destination.id}"
@@ -37,3 +37,59 @@ def all_subclasses(cls):
     return set(cls.__subclasses__()).union(
         [s for c in cls.__subclasses__() for s in all_subclasses(c)]
     )
+
+
+# pylint: disable-next=too-many-arguments,too-many-positional-arguments
+def docs_etag(
+    datastore_id, sequence_id, start_sequence_id, chunk_size, where=None, deltas=False
+):
+    """Return a strong ETag for a chunk of get_docs_since results.
+
+    The docs with start_sequence_id < _seq <= (start_sequence_id+chunk_size)
+    cannot change unless the datastore's sequence id changes, so the tuple
+    (datastore_id, sequence_id, start_sequence_id, chunk_size) identifies them,
+    with the where filter if there is one, and whether they are deltas.
+    """
+    key = [datastore_id, sequence_id, start_sequence_id, chunk_size]
+    if where:
+        key.append(where)
+    if deltas:
+        key.append("deltas")
+    the_hash = dict_hash(key)
+    return f'"{the_hash}"'
+
+
+def parse_where(where_json):
+    """Parse the where query parameter of the REST API.
+
+    :return None if where_json is empty, or a dict of field to value or list
+        of values (see Datastore.get_docs_since), or for a
+        MultiTableDatastore, of table to such a dict
+    Raise ValueError if it isn't one.
+    """
+    if not where_json:
+        return None
+    try:
+        where = json.loads(where_json)
+    except json.JSONDecodeError as err:
+        raise ValueError(f"where is not JSON: {where_json}") from err
+    if not isinstance(where, dict) or not all(
+        isinstance(value, (str, int, float, bool, list, dict))
+        for value in where.values()
+    ):
+        raise ValueError(f"where must map fields to values: {where_json}")
+    return where
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches etag.
+
+    See https://httpwg.org/specs/rfc9110.html#field.if-none-match
+    """
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so ignore any W/ prefix
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
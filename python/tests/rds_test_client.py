@@ -2,9 +2,12 @@
 
 import argparse
 import logging
+import threading
+import time
 
 import requests
 from reldatasync import util
+from reldatasync.changefeed import pull_when_notified
 from reldatasync.datastore import MemoryDatastore, RestClientSourceDatastore
 from reldatasync.document import _ID, Document
 from reldatasync.replicator import Replicator
@@ -53,6 +56,13 @@ def main():
     js = resp.json()
     assert js["documents"] == []
     assert js["current_sequence_id"] == 0
+    etag = resp.headers["ETag"]
+    assert etag
+
+    # Asking again with the ETag says nothing changed
+    resp = requests.get(server_url("table1/docs"), headers={"If-None-Match": etag})
+    assert resp.status_code == 304, resp.status_code
+    assert resp.headers["ETag"] == etag
 
     # Put three docs in table1
     d1 = Document({"_id": "1", "var1": "value1"})
@@ -90,6 +100,8 @@ def main():
     js = resp.json()
     assert len(js["documents"]) == 3, f"js is {js}"
     assert js["current_sequence_id"] == 3, f"js is {js}"
+    # The docs changed, so the ETag changed
+    assert resp.headers["ETag"] != etag
     docs = js["documents"]
     # server assigned revision numbers and sequence ids
     # compare data, except for _rev and _seq, set by server
@@ -123,6 +135,77 @@ def main():
     ds.check()
     remote_ds.check()
 
+    # A new client far behind loads a snapshot, and is then up to date
+    ds2 = MemoryDatastore("client2")
+    replicator = Replicator(ds2, remote_ds, snapshot_min_lag=2)
+    assert replicator.pull_changes() == len(ds.get_docs_since(0, 100)[1])
+    assert ds2.equals_no_seq(remote_ds)
+    assert ds2.get_peer_sequence_id(remote_ds.id) == ds.get_peer_sequence_id(
+        remote_ds.id
+    )
+    assert replicator.pull_changes() == 0
+
+    # A client that wants only some docs pulls only those, to the same seq
+    where_ds = RestClientSourceDatastore(
+        base_url, "table1", where={"var1": ["value2", "value4"]}
+    )
+    ds3 = MemoryDatastore("client3")
+    Replicator(ds3, where_ds).pull_changes()
+    assert sorted(doc[_ID] for doc in ds3.get_docs_since(0, 100)[1]) == ["2", "4"]
+    assert ds3.get_peer_sequence_id(where_ds.id) == ds.get_peer_sequence_id(
+        remote_ds.id
+    )
+    # and from a snapshot
+    ds3 = MemoryDatastore("client3")
+    assert Replicator(ds3, where_ds, snapshot_min_lag=2).pull_changes() == 2
+    resp = requests.get(server_url("table1/docs"), params={"where": "[1]"})
+    assert resp.status_code == 422, resp.status_code
+
+    # Pull and push only the fields that changed
+    ds4 = MemoryDatastore("client4", track_deltas=True)
+    replicator = Replicator(ds4, remote_ds, deltas=True)
+    replicator.sync_both_directions()
+    doc = ds4.get("2")
+    doc["var1"] = "value2a"
+    ds4.put(doc, increment_rev=True)
+    assert ds4.get_deltas_since(0, 100)[1][-1]["_base_rev"]
+    replicator.sync_both_directions()
+    assert remote_ds.get("2")["var1"] == "value2a"
+    assert ds4.equals_no_seq(remote_ds)
+
+    # Syncing again with nothing new uses the ETag of the last chunk
+    assert remote_ds._last_docs is not None
+    Replicator(ds, remote_ds).sync_both_directions()
+    assert ds.equals_no_seq(remote_ds)
+
+    # Long poll with nothing new times out with the same sequence id
+    server_seq = ds.get_peer_sequence_id(remote_ds.id)
+    start = time.monotonic()
+    assert remote_ds.wait_for_changes(server_seq, timeout=0.5) == server_seq
+    assert time.monotonic() - start >= 0.5
+
+    # Long poll for an old sequence id returns right away
+    assert remote_ds.wait_for_changes(0, timeout=10) == server_seq
+
+    # Another client puts a doc while we wait, and we pull only it
+    def put_later():
+        time.sleep(0.5)
+        resp = requests.post(
+            server_url("table1/doc"),
+            params={"increment_rev": True},
+            json={"_id": "6", "var1": "value6"},
+        )
+        assert resp.status_code == 200, resp.status_code
+
+    thread = threading.Thread(target=put_later)
+    thread.start()
+    assert pull_when_notified(Replicator(ds, remote_ds), timeout=10) == 1
+    thread.join()
+    assert ds.get("6")["var1"] == "value6"
+
+    # Server-sent events stream reports changes past the watermark
+    assert list(remote_ds.stream_changes(0, timeout=0.5)) == [server_seq + 1]
+
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
 import logging
+import tempfile
 
 from flask import Flask, Response, abort, request
 
 # from reldatasync.datastore import PostgresDatastore
 from reldatasync import util
-from reldatasync.datastore import MemoryDatastore
+from reldatasync.changefeed import notifier
+from reldatasync.datastore import MemoryDatastore, ResyncRequired
 from reldatasync.document import Document
 
 logger = logging.getLogger(__name__)
@@ -16,14 +18,21 @@ datastores = {}
 # The prefix of the URLs for interacting with the server
 SERVER_ROOT = "root"
 
+# Longest a client may wait for changes in one request, in seconds
+CHANGES_MAX_TIMEOUT = 60
+
+# Snapshots bigger than this many bytes go to a temp file, not memory
+SNAPSHOT_MAX_MEMORY = 10 * 1024 * 1024
+
 
 def _get_datastore(table, autocreate=True) -> MemoryDatastore:
     if table not in datastores and autocreate:
         # datastores[table] = PostgresDatastore('datastore', _connstr(), table)
-        datastores[table] = MemoryDatastore("server")
+        datastores[table] = MemoryDatastore("server", track_deltas=True)
     return datastores.get(table, None)
 
 
+# pylint: disable-next=too-many-statements
 def create_app():
     logging.info("SERVER STARTING")
     app = Flask(__name__)
@@ -83,12 +92,50 @@ def create_app():
         if not datastore:
             abort(404)
         if request.method == "GET":
-            # return docs
-            cur_seq_id, the_docs = datastore.get_docs_since(
-                int(request.args.get("start_sequence_id", 0)),
-                int(request.args.get("chunk_size", 10)),
+            start_sequence_id = int(request.args.get("start_sequence_id", 0))
+            chunk_size = int(request.args.get("chunk_size", 10))
+            peer_id = request.args.get("peer_id")
+            try:
+                where = util.parse_where(request.args.get("where"))
+            except ValueError as err:
+                return str(err), 422
+            deltas = request.args.get("deltas", "false") == "true"
+            if peer_id:
+                try:
+                    datastore.check_peer_sequence_id(start_sequence_id)
+                except ResyncRequired as err:
+                    return str(err), 410
+                datastore.ack_peer_sequence_id(peer_id, start_sequence_id)
+            etag = util.docs_etag(
+                datastore.id,
+                datastore.sequence_id,
+                start_sequence_id,
+                chunk_size,
+                where,
+                deltas,
+            )
+            if util.etag_matches(request.headers.get("If-None-Match"), etag):
+                return Response("", status=304, headers={"ETag": etag})
+            # return docs, or patches
+            get_docs_since = (
+                datastore.get_deltas_since if deltas else datastore.get_docs_since
             )
-            return {"current_sequence_id": cur_seq_id, "documents": the_docs}
+            cur_seq_id, the_docs = get_docs_since(start_sequence_id, chunk_size, where)
+            return (
+                {"current_sequence_id": cur_seq_id, "documents": the_docs},
+                {"ETag": etag},
+            )
+        if request.method == "POST" and request.args.get("deltas") == "true":
+            # put docs and patches
+            try:
+                num_put, missing_seqs = datastore.put_deltas(
+                    [Document(the_doc) for the_doc in request.json]
+                )
+            except ValueError as err:
+                return str(err), 422
+            finally:
+                notifier.notify(table, datastore.sequence_id)
+            return {"num_docs_put": num_put, "missing_seqs": missing_seqs}
         if request.method == "POST":
             # put docs
             num_put = 0
@@ -103,10 +150,35 @@ def create_app():
                     new_docs.append(new_doc)
             except ValueError as err:
                 return str(err), 422
+            finally:
+                notifier.notify(table, datastore.sequence_id)
             # TODO: should response have docs with clocks set?  I think yes.
             return {"num_docs_put": num_put, "documents": new_docs}
         return {}
 
+    @app.route(f"/{SERVER_ROOT}/<table>/snapshot", methods=["GET"])
+    def snapshot(table):
+        datastore = _get_datastore(table, autocreate=False)
+        if not datastore:
+            abort(404)
+        try:
+            where = util.parse_where(request.args.get("where"))
+        except ValueError as err:
+            return str(err), 422
+        snapshot_file = tempfile.SpooledTemporaryFile(max_size=SNAPSHOT_MAX_MEMORY)
+        seq = datastore.write_snapshot(
+            snapshot_file, int(request.args.get("chunk_size", 1000)), where
+        )
+        peer_id = request.args.get("peer_id")
+        if peer_id:
+            datastore.ack_peer_sequence_id(peer_id, seq)
+        snapshot_file.seek(0)
+        return Response(
+            snapshot_file,
+            mimetype="application/gzip",
+            headers={"X-Sequence-Id": str(seq)},
+        )
+
     @app.route(f"/{SERVER_ROOT}/<table>/doc/<docid>", methods=["GET"])
     @app.route(
         f"/{SERVER_ROOT}/<table>/doc", methods=["POST"], defaults={"docid": None}
@@ -129,9 +201,44 @@ def create_app():
             except ValueError as err:
                 return str(err), 422
 
+            notifier.notify(table, datastore.sequence_id)
             return {"num_docs_put": num_put, "document": new_doc}
         return {}
 
+    @app.route(f"/{SERVER_ROOT}/<table>/changes", methods=["GET"])
+    def changes(table):
+        datastore = _get_datastore(table, autocreate=False)
+        if not datastore:
+            abort(404)
+        seq = notifier.wait(
+            table,
+            int(request.args.get("start_sequence_id", 0)),
+            min(float(request.args.get("timeout", 30)), CHANGES_MAX_TIMEOUT),
+            get_sequence_id=lambda: datastore.sequence_id,
+        )
+        return {"current_sequence_id": seq}
+
+    @app.route(f"/{SERVER_ROOT}/<table>/changes/stream", methods=["GET"])
+    def changes_stream(table):
+        datastore = _get_datastore(table, autocreate=False)
+        if not datastore:
+            abort(404)
+        # A reconnecting EventSource tells us the last id it got
+        start_sequence_id = int(
+            request.headers.get(
+                "Last-Event-ID", request.args.get("start_sequence_id", 0)
+            )
+        )
+        events = notifier.stream(
+            table,
+            start_sequence_id,
+            float(request.args.get("timeout", 300)),
+            get_sequence_id=lambda: datastore.sequence_id,
+        )
+        return Response(
+            events, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+        )
+
     return app
 
 
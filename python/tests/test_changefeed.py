@@ -0,0 +1,68 @@
+import threading
+import time
+import unittest
+
+from reldatasync.changefeed import SequenceNotifier
+
+
+class TestSequenceNotifier(unittest.TestCase):
+    def test_wait_already_past(self):
+        notifier = SequenceNotifier()
+        notifier.notify("ds", 3)
+        self.assertEqual(3, notifier.sequence_id("ds"))
+        # returns right away
+        self.assertEqual(3, notifier.wait("ds", 2, timeout=10))
+
+    def test_wait_timeout(self):
+        notifier = SequenceNotifier()
+        notifier.notify("ds", 3)
+        start = time.monotonic()
+        self.assertEqual(3, notifier.wait("ds", 3, timeout=0.2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        # other keys are separate
+        self.assertEqual(0, notifier.wait("other", 0, timeout=0))
+
+    def test_notify_wakes_waiter(self):
+        notifier = SequenceNotifier()
+
+        def notify_later():
+            time.sleep(0.2)
+            notifier.notify("ds", 1)
+
+        thread = threading.Thread(target=notify_later)
+        thread.start()
+        start = time.monotonic()
+        # poll_interval is long, so only notify() can wake us early
+        self.assertEqual(1, notifier.wait("ds", 0, timeout=10, poll_interval=10))
+        self.assertLess(time.monotonic() - start, 5)
+        thread.join()
+
+    def test_notify_never_goes_backwards(self):
+        notifier = SequenceNotifier()
+        notifier.notify("ds", 3)
+        notifier.notify("ds", 2)
+        self.assertEqual(3, notifier.sequence_id("ds"))
+
+    def test_wait_get_sequence_id(self):
+        # get_sequence_id finds changes nobody notified us about
+        notifier = SequenceNotifier()
+        seqs = iter([0, 0, 5])
+        self.assertEqual(
+            5,
+            notifier.wait(
+                "ds", 0, timeout=10, get_sequence_id=lambda: next(seqs), poll_interval=0
+            ),
+        )
+
+    def test_stream(self):
+        notifier = SequenceNotifier()
+        notifier.notify("ds", 2)
+        events = list(notifier.stream("ds", 0, timeout=0.2, keepalive=0.1))
+        self.assertEqual(
+            'id: 2\nevent: sequence_id\ndata: {"current_sequence_id": 2}\n\n',
+            events[0],
+        )
+        # nothing else changed, so the rest are keepalives
+        self.assertTrue(events[1:])
+        for event in events[1:]:
+            self.assertEqual(": keepalive\n\n", event)
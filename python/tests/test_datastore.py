@@ -1,22 +1,38 @@
+import io
 import logging
 import os
 import random
 import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from abc import abstractmethod
-from unittest import SkipTest
+from unittest import SkipTest, skipUnless
 
 import psycopg2
 from reldatasync import util
 from reldatasync.datastore import (
     Datastore,
     MemoryDatastore,
+    MultiTableDatastore,
     NoSuchTable,
     PostgresDatastore,
+    ResyncRequired,
     SqliteDatastore,
+    TableMetadataCache,
 )
-from reldatasync.document import _DELETED, _ID, _REV, _SEQ, Document
-from reldatasync.replicator import Replicator
+from reldatasync.document import (
+    _BASE_REV,
+    _DELETED,
+    _DELTA,
+    _ID,
+    _REV,
+    _SEQ,
+    _TABLE,
+    Document,
+)
+from reldatasync.replicator import ReplicationError, Replicator
 from reldatasync.vectorclock import VectorClock
 
 logger = logging.getLogger(__name__)
@@ -24,6 +40,9 @@ logger = logging.getLogger(__name__)
 # Get log level from environment so we can set it for python -m unittest
 util.logging_basic_config()
 
+# Docs per connection for benchmarks, which only run if this is set
+BENCHMARK_NUM = int(os.getenv("RDS_BENCHMARK_NUM", "0"))
+
 
 class _TestDatastore(unittest.TestCase):
     """Base class for testing datastores."""
@@ -114,6 +133,38 @@ class _TestDatastore(unittest.TestCase):
         with ds:
             self.assertEqual(id1, ds.id)
 
+    def test_metadata_cache(self):
+        if self.server.__class__ == MemoryDatastore:
+            # MemoryDatastore has no table metadata
+            return
+
+        cache = TableMetadataCache()
+        ds = self.server.__class__("server", self.server.conn, "docs1")
+        ds.metadata_cache = cache
+        with ds:
+            ds.put(Document({_ID: "A", "value": "val1"}), increment_rev=True)
+        self.assertEqual(1, len(cache))
+
+        # A second datastore with the same cache uses the cached metadata
+        ds2 = self.server.__class__(
+            "server", self.server.conn, "docs1", metadata_cache=cache
+        )
+        with ds2:
+            self.assertIs(
+                cache.get(("server", "docs1"))["columnnames"], ds2.columnnames
+            )
+            self.assertEqual("val1", ds2.get("A")["value"])
+            ds2.put(Document({_ID: "B", "value": "val2"}), increment_rev=True)
+            self.assertEqual("val2", ds2.get("B")["value"])
+
+        # A datastore can be entered again after it exits
+        with ds:
+            self.assertEqual(2, ds.sequence_id)
+            self.assertEqual("val2", ds.get("B")["value"])
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
     def test_new_rev_and_seq(self):
         rev = ""
         rev, seq = self.server.new_rev_and_seq(rev)
@@ -124,6 +175,31 @@ class _TestDatastore(unittest.TestCase):
         self.assertEqual(2, seq)
         self.assertEqual(str(VectorClock({"server_id": 2})), rev)
 
+    def test_new_revs_and_seqs(self):
+        self.assertEqual([], self.server.new_revs_and_seqs([]))
+
+        revs_and_seqs = self.server.new_revs_and_seqs(["", None, "{}"])
+        self.assertEqual(
+            [
+                (str(VectorClock({"server_id": 1})), 1),
+                (str(VectorClock({"server_id": 2})), 2),
+                (str(VectorClock({"server_id": 3})), 3),
+            ],
+            revs_and_seqs,
+        )
+        self.assertEqual(3, self.server.sequence_id)
+
+        # existing revs keep their other clocks
+        rev = str(VectorClock({"other_id": 7, "server_id": 1}))
+        revs_and_seqs = self.server.new_revs_and_seqs([rev])
+        self.assertEqual(
+            [(str(VectorClock({"other_id": 7, "server_id": 4})), 4)], revs_and_seqs
+        )
+
+        # and the single version continues after them
+        _rev, seq = self.server.new_rev_and_seq("")
+        self.assertEqual(5, seq)
+
     def test_nonoverlapping_sync(self):
         """Non-overlapping documents from datastore"""
         # server makes object A v1
@@ -211,6 +287,86 @@ class _TestDatastore(unittest.TestCase):
         self.assertEqual("val2", new_doc["value"])
         self.assertEqual(self.server.get("A"), new_doc)
 
+    def test_put_many(self):
+        """put_many puts docs with newer revs, like put"""
+        _, doc_a = self.server.put(Document({_ID: "A", "value": "a1"}), True)
+        _, doc_b = self.server.put(Document({_ID: "B", "value": "b1"}), True)
+
+        # A is newer, B is older, C is new
+        doc_a, doc_b = doc_a.copy(), doc_b.copy()
+        doc_a["value"] = "a2"
+        rev = VectorClock.from_string(doc_a[_REV])
+        rev.set_clock("other", 1)
+        doc_a[_REV] = str(rev)
+        doc_b["value"] = "b0"
+        doc_b[_REV] = "{}"
+        doc_c = Document({_ID: "C", _REV: '{"other": 2}', "value": "c1"})
+        self.assertEqual(2, self.server.put_many([doc_a, doc_b, doc_c]))
+
+        self.assertEqual(4, self.server.sequence_id)
+        self.assertEqual("a2", self.server.get("A")["value"])
+        self.assertEqual("b1", self.server.get("B")["value"])
+        self.assertEqual(
+            [("B", 2), ("A", 3), ("C", 4)],
+            [(doc[_ID], doc[_SEQ]) for doc in self.server.get_docs_since(0, 10)[1]],
+        )
+        self.assertTrue(self.server.check())
+
+        # Nothing newer, nothing put
+        self.assertEqual(0, self.server.put_many([doc_a, doc_c]))
+        with self.assertRaises(ValueError):
+            self.server.put_many([Document({_ID: "D"})])
+
+    def test_snapshot(self):
+        """A far behind peer loads a snapshot, then pulls changes after it"""
+        for idx in range(5):
+            self.server.put(Document({_ID: f"A{idx}", "value": "v"}), True)
+        self.server.delete("A0")
+
+        snapshot = io.BytesIO()
+        self.assertEqual(6, self.server.write_snapshot(snapshot, chunk_size=2))
+        snapshot.seek(0)
+        self.assertEqual((6, 5), self.client.load_snapshot(snapshot, chunk_size=2))
+        self.assertTrue(self.server.equals_no_seq(self.client))
+
+        # The Replicator loads one when the lag is big enough
+        replicator = Replicator(self.third, self.server, snapshot_min_lag=6)
+        self.assertEqual(5, replicator.pull_changes())
+        self.assertEqual(6, self.third.get_peer_sequence_id(self.server.id))
+        self.assertTrue(self.server.equals_no_seq(self.third))
+        self.assertTrue(self.third.check())
+
+        # and pulls chunks when it isn't
+        self.server.put(Document({_ID: "A1", "value": "v2"}), True)
+        self.assertEqual(1, replicator.pull_changes())
+        self.assertEqual("v2", self.third.get("A1")["value"])
+
+    def test_chunk_transactions(self):
+        """A doc that fails keeps the docs before it, and is tried again"""
+        source = MemoryDatastore("source")
+        for idx in range(5):
+            source.put(Document({_ID: f"A{idx}", "value": "v"}), True)
+        # A rev we can't parse
+        good_rev = source.datastore["A3"][_REV]
+        source.datastore["A3"][_REV] = "not json"
+
+        replicator = Replicator(
+            self.server, source, chunk_size=2, chunk_transactions=True
+        )
+        with self.assertRaises(ReplicationError), self.assertLogs(level="WARNING"):
+            replicator.pull_changes()
+        self.assertEqual(
+            ["A0", "A1", "A2"],
+            [doc[_ID] for doc in self.server.get_docs_since(0, 10)[1]],
+        )
+        self.assertEqual(3, self.server.get_peer_sequence_id(source.id))
+        self.assertTrue(self.server.check())
+
+        # Once it's fixed, the next pull starts from it
+        source.datastore["A3"][_REV] = good_rev
+        self.assertEqual(2, replicator.pull_changes())
+        self.assertTrue(self.server.equals_no_seq(source))
+
     def test_overlapping_sync(self):
         """Overlapping documents from datastore"""
         # server makes object A v1
@@ -319,6 +475,71 @@ class _TestDatastore(unittest.TestCase):
             docs,
         )
 
+    def test_get_docs_since_where(self):
+        """Only docs matching where come back, up to the same sequence id"""
+        for the_id, value in [("A", "a"), ("B", "b"), ("C", "a"), ("D", "d")]:
+            self.server.put(Document({_ID: the_id, "value": value}), True)
+        self.server.delete("C")
+
+        seq, docs = self.server.get_docs_since(0, 10, {"value": "a"})
+        self.assertEqual(5, seq)
+        self.assertEqual(["A", "C"], [doc[_ID] for doc in docs])
+        # The tombstone is in the slice too
+        self.assertTrue(docs[1][_DELETED])
+        seq, docs = self.server.get_docs_since(1, 2, {"value": ["a", "b"]})
+        self.assertEqual(5, seq)
+        self.assertEqual(["B"], [doc[_ID] for doc in docs])
+        self.assertEqual((5, []), self.server.get_docs_since(0, 10, {"value": []}))
+
+        # A peer loads only its slice from a snapshot
+        snapshot = io.BytesIO()
+        self.assertEqual(5, self.server.write_snapshot(snapshot, 2, {"value": "d"}))
+        snapshot.seek(0)
+        client = MemoryDatastore("client")
+        self.assertEqual((5, 1), client.load_snapshot(snapshot))
+        self.assertEqual("d", client.get("D")["value"])
+
+    def test_deltas(self):
+        """A peer that has a doc gets only the fields that changed"""
+        server = self.delta_datastore()
+        for the_id in ["A", "B"]:
+            server.put(Document({_ID: the_id, "value": the_id + "1"}), True)
+        replicator = Replicator(self.client, server, deltas=True)
+        self.assertEqual(2, replicator.pull_changes())
+
+        doc = server.get("A")
+        doc["value"] = "A2"
+        server.put(doc, True)
+        server.delete("B")
+        seq, patches = server.get_deltas_since(2, 10)
+        self.assertEqual(4, seq)
+        self.assertEqual(
+            [
+                ({_ID, _REV, _SEQ, _DELTA, _BASE_REV, "value"}, "A2"),
+                ({_ID, _REV, _SEQ, _DELTA, _BASE_REV, _DELETED}, None),
+            ],
+            [(set(patch), patch.get("value")) for patch in patches],
+        )
+        # A peer without the docs can't apply them
+        self.assertEqual((0, [3, 4]), MemoryDatastore("new").put_deltas(patches))
+        with self.assertRaises(ValueError):
+            self.client.put(patches[0])
+
+        self.assertEqual(2, replicator.pull_changes())
+        self.assertEqual("A2", self.client.get("A")["value"])
+        self.assertIsNone(self.client.get("B"))
+        self.assertTrue(server.equals_no_seq(self.client))
+
+        # A patch of a version the peer doesn't have, so it gets the whole doc
+        for value in ["A3", "A4"]:
+            doc = server.get("A")
+            doc["value"] = value
+            server.put(doc, True)
+        replicator = Replicator(self.client, server, chunk_size=1, deltas=True)
+        self.assertEqual(1, replicator.pull_changes())
+        self.assertEqual("A4", self.client.get("A")["value"])
+        self.assertTrue(server.equals_no_seq(self.client))
+
     def test_delete_sync(self):
         """Test that deletes get through syncing"""
         # server makes object A v1
@@ -411,6 +632,49 @@ class _TestDatastore(unittest.TestCase):
             self.server.get("C", include_deleted=True),
         )
 
+    def test_purge_tombstones(self):
+        self.server.put(Document({_ID: "A", "value": "val1"}), increment_rev=True)
+        self.server.put(Document({_ID: "B", "value": "val2"}), increment_rev=True)
+        self.server.delete("A")
+
+        # no peers yet, so nothing is purged
+        self.assertEqual(0, self.server.purge_tombstones())
+
+        # client and third pull everything so far, then client pulls once more
+        Replicator(self.client, self.server).pull_changes()
+        Replicator(self.third, self.server).pull_changes()
+        self.server.delete("B")
+        Replicator(self.client, self.server).pull_changes()
+        self.assertEqual(
+            {self.client.id: 4, self.third.id: 3}, self.server.get_peer_acks()
+        )
+        self.assertEqual(3, self.server.gc_horizon())
+
+        # Only A's tombstone has been seen by every peer
+        self.assertEqual(1, self.server.purge_tombstones())
+        self.assertIsNone(self.server.get("A", include_deleted=True))
+        self.assertTrue(self.server.get("B", include_deleted=True)[_DELETED])
+        self.assertEqual(3, self.server.get_purged_sequence_id())
+
+        # Forget third, and it falls behind
+        self.server.forget_peer(self.third.id)
+        self.assertEqual(1, self.server.purge_tombstones())
+        self.assertEqual(4, self.server.get_purged_sequence_id())
+        self.assertTrue(self.server.check())
+
+        # third must resync, even before pushing its own changes
+        self.third.put(Document({_ID: "C", "value": "val3"}), increment_rev=True)
+        with self.assertRaises(ResyncRequired):
+            Replicator(self.third, self.server).sync_both_directions()
+        self.assertIsNone(self.server.get("C"))
+
+        # client is up to date, and doesn't push back purged tombstones,
+        # so a new peer starting from scratch gets nothing
+        Replicator(self.client, self.server).sync_both_directions()
+        self.assertEqual(
+            0, Replicator(MemoryDatastore("new"), self.server).pull_changes()
+        )
+
     def test_delete_sync2(self):
         """Test a particular case that failed previously."""
 
@@ -625,6 +889,9 @@ class TestMemoryDatastore(_TestDatastore):
         self.client = MemoryDatastore("client", "client_id")
         self.third = MemoryDatastore("third", "third_id")
 
+    def delta_datastore(self):
+        return MemoryDatastore("deltas", "deltas_id", track_deltas=True)
+
 
 class _TestDatabase:
     def __init__(self, dbname, dsname):
@@ -663,7 +930,22 @@ class _TestDatabase:
                 "data_sync_revisions",
                 "datastore_id varchar(100) not null,"
                 "datastore_name varchar(1000) not null,"
-                " sequence_id int not null",
+                " sequence_id int not null,"
+                " purged_sequence_id int",
+            )
+            self._create_table_if_not_exists(
+                "data_sync_peers",
+                "datastore_id varchar(100) not null,"
+                " peer_id varchar(100) not null,"
+                " sequence_id int not null,"
+                " UNIQUE (datastore_id, peer_id)",
+            )
+            self._create_table_if_not_exists(
+                "data_sync_peer_seqs",
+                "datastore_id varchar(100) not null,"
+                " peer_id varchar(100) not null,"
+                " sequence_id int not null,"
+                " UNIQUE (datastore_id, peer_id)",
             )
             # docs1 only needed on server, and docs2 on client
             # but it's easier to just create both tables on both
@@ -676,6 +958,8 @@ class _TestDatabase:
             """
             self._create_table_if_not_exists("docs1", docs_def)
             self._create_table_if_not_exists("docs2", docs_def)
+            # A table that tracks deltas
+            self._create_table_if_not_exists("docs3", docs_def + ", _delta text")
 
         self.exec_sql(exec_func, dbname=self.dbname)
 
@@ -686,9 +970,15 @@ class _TestDatabase:
             # reset sequence_id so tests start from 0
             # this breaks the abstraction barrier, but means the datastore
             # classes don't have to do twisted things just for testing
-            curs.execute("UPDATE data_sync_revisions SET sequence_id = 0")
+            curs.execute(
+                "UPDATE data_sync_revisions"
+                " SET sequence_id = 0, purged_sequence_id = NULL"
+            )
+            curs.execute("DELETE FROM data_sync_peers")
+            curs.execute("DELETE FROM data_sync_peer_seqs")
             curs.execute("DELETE FROM docs1")
             curs.execute("DELETE FROM docs2")
+            curs.execute("DELETE FROM docs3")
 
         self.exec_sql(exec_func, dbname=self.dbname)
 
@@ -711,12 +1001,16 @@ class _SqliteTestDatabase(_TestDatabase):
             # Use autocommit to not need transactions:
             isolation_level=None,
         )
-        self.datastore = SqliteDatastore(
-            self.dsname, self._conn, table, datastore_id=datastore_id
-        )
+        self.datastore = self.make_datastore(table, datastore_id)
         # pylint: disable-next=unnecessary-dunder-call
         self.datastore.__enter__()
 
+    def make_datastore(self, table, datastore_id):
+        """Make another datastore of a table, on our connection."""
+        return SqliteDatastore(
+            self.dsname, self._conn, table, datastore_id=datastore_id, track_peers=True
+        )
+
     def create_test_db_and_tables(self):
         # TODO: factor this out
         self._create_test_tables()
@@ -748,6 +1042,9 @@ class _SqliteTestDatabase(_TestDatabase):
 
 
 class _PostgresTestDatabase(_TestDatabase):
+    use_sequence = False
+    bulk_load_min_docs = 100
+
     # TODO: factor out connect
     def connect(self, table, datastore_id=None):
         if datastore_id is None:
@@ -755,12 +1052,22 @@ class _PostgresTestDatabase(_TestDatabase):
         self._conn = psycopg2.connect(self._dbconnstr(self.dbname))
         # If we want to test with autocommit:
         # self._conn.autocommit = True
-        self.datastore = PostgresDatastore(
-            self.dsname, self._conn, table, datastore_id=datastore_id
-        )
+        self.datastore = self.make_datastore(table, datastore_id)
         # pylint: disable-next=unnecessary-dunder-call
         self.datastore.__enter__()
 
+    def make_datastore(self, table, datastore_id):
+        """Make another datastore of a table, on our connection."""
+        return PostgresDatastore(
+            self.dsname,
+            self._conn,
+            table,
+            datastore_id=datastore_id,
+            track_peers=True,
+            use_sequence=self.use_sequence,
+            bulk_load_min_docs=self.bulk_load_min_docs,
+        )
+
     @staticmethod
     def _dbconnstr(dbname=None):
         """Connect to test database on host db, user postgres by default.
@@ -804,6 +1111,20 @@ class _PostgresTestDatabase(_TestDatabase):
                 logger.debug(f"Closed conn 1 {connstr}")
         return ret
 
+    def clear_and_reset_tables(self):
+        super().clear_and_reset_tables()
+
+        def exec_func(curs):
+            # Sequences of use_sequence datastores, which committed tests leave
+            curs.execute(
+                "SELECT relname FROM pg_class"
+                " WHERE relkind = 'S' AND relname LIKE 'data\\_sync\\_seq\\_%'"
+            )
+            for (sequence_name,) in curs.fetchall():
+                curs.execute(f"DROP SEQUENCE {sequence_name}")
+
+        self.exec_sql(exec_func, dbname=self.dbname)
+
     def drop_db(self):
         self.exec_sql(lambda curs: curs.execute(f"DROP DATABASE {self.dbname}"))
 
@@ -961,6 +1282,10 @@ class _TestDatabaseDatastore(_TestDatastore):
     def setUp(self):
         super().setUp()
 
+        # Close the last test's connections, which would otherwise stay open
+        # (and in a transaction) after init_dbclass replaces them
+        self._testdbs.close_connections()
+
         # Clear tables
         self._testdbs.serverdb.clear_and_reset_tables()
         self._testdbs.clientdb.clear_and_reset_tables()
@@ -979,10 +1304,330 @@ class _TestDatabaseDatastore(_TestDatastore):
         self.client = self._testdbs.client
         self.third = self._testdbs.third
 
+    def delta_datastore(self):
+        datastore = self._testdbs.serverdb.make_datastore("docs3", "deltas_id")
+        # pylint: disable-next=unnecessary-dunder-call
+        datastore.__enter__()
+        self.addCleanup(datastore.__exit__)
+        return datastore
+
+    def test_get_docs_since_where_bad_column(self):
+        # Column names go in the SQL, so we only take the table's
+        with self.assertRaises(ValueError):
+            self.server.get_docs_since(0, 10, {"value = value OR 1": 1})
+
+    def test_multi_table(self):
+        """Tables of one datastore sync as one stream of docs"""
+        serverdb = self._testdbs.serverdb
+        with MultiTableDatastore(
+            {
+                "docs1": serverdb.make_datastore("docs1", self.server.id),
+                "docs2": serverdb.make_datastore("docs2", self.server.id),
+            }
+        ) as multi:
+            multi.put(Document({_ID: "A", _TABLE: "docs1", "value": "a"}), True)
+            multi.put(Document({_ID: "B", _TABLE: "docs2", "value": "b"}), True)
+            multi.put(Document({_ID: "C", _TABLE: "docs1", "value": "c"}), True)
+
+            # One sequence for both tables
+            self.assertEqual(3, multi.sequence_id)
+            seq, docs = multi.get_docs_since(0, 10)
+            self.assertEqual(3, seq)
+            self.assertEqual(
+                [(1, "docs1", "A"), (2, "docs2", "B"), (3, "docs1", "C")],
+                [(doc[_SEQ], doc[_TABLE], doc[_ID]) for doc in docs],
+            )
+            self.assertEqual(
+                ["A", "B"],
+                [
+                    doc[_ID]
+                    for doc in multi.get_docs_since(0, 10, {"docs1": {"value": "a"}})[1]
+                ],
+            )
+            self.assertEqual("b", multi.get(("docs2", "B"))["value"])
+            self.assertIsNone(multi.get(("docs1", "B")))
+
+            # Sync both tables with one datastore, both ways
+            client = MemoryDatastore("client")
+            Replicator(client, multi).sync_both_directions()
+            self.assertEqual("docs2", client.get("B")[_TABLE])
+            doc = client.get("B").copy()
+            doc["value"] = "bb"
+            client.put(doc, True)
+            client.put(Document({_ID: "D", _TABLE: "docs2", "value": "d"}), True)
+            Replicator(client, multi).sync_both_directions()
+            self.assertEqual("bb", multi.get(("docs2", "B"))["value"])
+            self.assertEqual(5, multi.get(("docs2", "D"))[_SEQ])
+
+            # Docs must say which table they are in
+            with self.assertRaises(ValueError):
+                multi.put(Document({_ID: "E", "value": "e"}), True)
+            with self.assertRaises(ValueError):
+                multi.put(Document({_ID: "E", _TABLE: "docs3", "value": "e"}), True)
+
 
 class TestPostgresDatastore(_TestDatabaseDatastore):
     _testdbclass = _PostgresTestDatabase
 
+    def test_chunk_transactions_db_error(self):
+        """After a database error, the docs before it are still committed"""
+        source = MemoryDatastore("source")
+        source.put(Document({_ID: "A0"}), True)
+        # Too long for _rev varchar(255)
+        source.put(Document({_ID: "A1", _REV: str(VectorClock({"x" * 300: 1}))}))
+        source.put(Document({_ID: "A2"}), True)
+
+        replicator = Replicator(self.server, source, chunk_transactions=True)
+        with self.assertRaises(ReplicationError), self.assertLogs(level="WARNING"):
+            replicator.pull_changes()
+        self.assertEqual(
+            ["A0"], [doc[_ID] for doc in self.server.get_docs_since(0, 10)[1]]
+        )
+        self.assertEqual(1, self.server.get_peer_sequence_id(source.id))
+
+
+class _PostgresBulkLoadTestDatabase(_PostgresTestDatabase):
+    # All puts from the Replicator go through COPY
+    bulk_load_min_docs = 1
+
+
+class TestPostgresBulkLoadDatastore(_TestDatabaseDatastore):
+    _testdbclass = _PostgresBulkLoadTestDatabase
+
+    def test_bulk_load_values(self):
+        """Values COPY has to escape, and NULLs, come through."""
+        value = "tab\there\nnew line\\N back\\slash"
+        docs = [
+            Document({_ID: "A", _REV: '{"other": 1}', "value": value}),
+            Document({_ID: "B", _REV: '{"other": 2}', _DELETED: True}),
+        ]
+        self.assertEqual(2, self.server.put_many(docs))
+        self.assertEqual(value, self.server.get("A")["value"])
+        doc_b = self.server.get("B", include_deleted=True)
+        self.assertTrue(doc_b[_DELETED])
+        self.assertIsNone(doc_b["value"])
+
+
+class _PostgresSequenceTestDatabase(_PostgresTestDatabase):
+    use_sequence = True
+
+
+class TestPostgresSequenceDatastore(_TestDatabaseDatastore):
+    _testdbclass = _PostgresSequenceTestDatabase
+
+    def test_concurrent_writers(self):
+        """The sequence id doesn't pass a write that hasn't committed."""
+        conns = []
+
+        def connect():
+            conns.append(
+                psycopg2.connect(
+                    _PostgresTestDatabase._dbconnstr(_TestDatabases.SERVER_DBNAME)
+                )
+            )
+            return PostgresDatastore(
+                "concurrent", conns[-1], "docs1", use_sequence=True
+            )
+
+        try:
+            # Create the datastore and its sequence
+            with connect():
+                pass
+            conns[0].commit()
+
+            with connect() as writer1, connect() as writer2, connect() as reader:
+                writer1.put(Document({_ID: "conc1"}), increment_rev=True)
+                writer2.put(Document({_ID: "conc2"}), increment_rev=True)
+                writer2.conn.commit()
+                self.assertEqual(
+                    [1, 2], [writer1.get("conc1")[_SEQ], writer2.get("conc2")[_SEQ]]
+                )
+
+                # The reader waits for writer1, which commits later
+                timer = threading.Timer(0.5, writer1.conn.commit)
+                timer.start()
+                start = time.monotonic()
+                seq, docs = reader.get_docs_since(0, 10)
+                self.assertGreaterEqual(time.monotonic() - start, 0.4)
+                timer.join()
+                self.assertEqual(2, seq)
+                self.assertEqual(["conc1", "conc2"], [doc[_ID] for doc in docs])
+        finally:
+            for conn in conns:
+                conn.close()
+
+            def cleanup(curs):
+                curs.execute("DELETE FROM docs1 WHERE _id LIKE 'conc%'")
+                curs.execute(
+                    "DELETE FROM data_sync_revisions"
+                    " WHERE datastore_name = 'concurrent'"
+                )
+                sequence_name = PostgresDatastore.get_sequence_name("concurrent")
+                curs.execute(f"DROP SEQUENCE IF EXISTS {sequence_name}")
+
+            self._testdbs.serverdb.exec_sql(
+                cleanup, dbname=_TestDatabases.SERVER_DBNAME
+            )
+
+
+@skipUnless(BENCHMARK_NUM, "Set RDS_BENCHMARK_NUM to run benchmarks")
+class PostgresSequenceBenchmark(unittest.TestCase):
+    """Compare concurrent write throughput with and without use_sequence.
+
+    Each write is its own transaction, in a new datastore, as in Django.
+    """
+
+    DBNAME = "rds_test_benchmark"
+    THREADS = int(os.getenv("RDS_BENCHMARK_THREADS", "8"))
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.testdb = _PostgresTestDatabase(cls.DBNAME, "benchmark")
+        cls.testdb.create_test_db_and_tables()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.testdb.drop_db()
+
+    def _write(self, use_sequence, thread_num, cache):
+        conn = psycopg2.connect(_PostgresTestDatabase._dbconnstr(self.DBNAME))
+        try:
+            for idx in range(BENCHMARK_NUM):
+                with PostgresDatastore(
+                    "benchmark",
+                    conn,
+                    "docs1",
+                    metadata_cache=cache,
+                    use_sequence=use_sequence,
+                ) as ds:
+                    ds.put(
+                        Document({_ID: f"{use_sequence}-{thread_num}-{idx}"}),
+                        increment_rev=True,
+                    )
+                conn.commit()
+        finally:
+            conn.close()
+
+    def _report(self, use_sequence):
+        conn = psycopg2.connect(_PostgresTestDatabase._dbconnstr(self.DBNAME))
+        cache = TableMetadataCache()
+        try:
+            # Create the datastore (and sequence) before the threads race to
+            with PostgresDatastore(
+                "benchmark",
+                conn,
+                "docs1",
+                metadata_cache=cache,
+                use_sequence=use_sequence,
+            ) as ds:
+                start_seq = ds.get_docs_since(0, 0)[0]
+            conn.commit()
+
+            threads = [
+                threading.Thread(
+                    target=self._write, args=(use_sequence, thread_num, cache)
+                )
+                for thread_num in range(self.THREADS)
+            ]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            num = self.THREADS * BENCHMARK_NUM
+            print(
+                f"\nuse_sequence={use_sequence}: {self.THREADS} connections wrote"
+                f" {num} docs in {elapsed:.3f}s ({num / elapsed:.0f}/s)"
+            )
+            with PostgresDatastore(
+                "benchmark", conn, "docs1", use_sequence=use_sequence
+            ) as ds:
+                self.assertEqual(start_seq + num, ds.get_docs_since(0, 0)[0])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def test_write_throughput(self):
+        self._report(use_sequence=False)
+        self._report(use_sequence=True)
+
+
+@skipUnless(BENCHMARK_NUM, "Set RDS_BENCHMARK_NUM to run benchmarks")
+class ChunkTransactionBenchmark(unittest.TestCase):
+    """Compare pulling docs with and without chunk_transactions.
+
+    Connections are in autocommit mode, as in rds_client.py, so without
+    chunk_transactions each statement is its own transaction.
+    """
+
+    CHUNK_SIZE = 100
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.source = MemoryDatastore("source")
+        for idx in range(BENCHMARK_NUM):
+            cls.source.put(Document({_ID: f"doc{idx}", "value": "v"}), True)
+
+    def _report(self, name, datastore, chunk_transactions):
+        with datastore:
+            start = time.perf_counter()
+            Replicator(
+                datastore,
+                self.source,
+                self.CHUNK_SIZE,
+                chunk_transactions=chunk_transactions,
+            ).pull_changes()
+            elapsed = time.perf_counter() - start
+            self.assertEqual(BENCHMARK_NUM, datastore.sequence_id)
+        print(
+            f"\n{name} chunk_transactions={chunk_transactions}:"
+            f" {BENCHMARK_NUM} docs in {elapsed:.3f}s ({BENCHMARK_NUM / elapsed:.0f}/s)"
+        )
+
+    def test_sqlite(self):
+        for chunk_transactions in (False, True):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                testdb = _SqliteTestDatabase(
+                    os.path.join(tmpdir, "benchmark.db"), "benchmark"
+                )
+                testdb.create_test_db_and_tables()
+                conn = sqlite3.connect(testdb.dbname, isolation_level=None)
+                try:
+                    self._report(
+                        "sqlite",
+                        SqliteDatastore("benchmark", conn, "docs1"),
+                        chunk_transactions,
+                    )
+                finally:
+                    conn.close()
+
+    def test_postgres(self):
+        testdb = _PostgresTestDatabase("rds_test_benchmark", "benchmark")
+        testdb.create_test_db_and_tables()
+        try:
+            for chunk_transactions in (False, True):
+                testdb.clear_and_reset_tables()
+                conn = psycopg2.connect(_PostgresTestDatabase._dbconnstr(testdb.dbname))
+                conn.autocommit = True
+                try:
+                    self._report(
+                        "postgres",
+                        # Without COPY, to compare transactions only
+                        PostgresDatastore(
+                            "benchmark", conn, "docs1", bulk_load_min_docs=None
+                        ),
+                        chunk_transactions,
+                    )
+                finally:
+                    conn.close()
+        finally:
+            testdb.drop_db()
+
 
 class TestSqliteDatastore(_TestDatabaseDatastore):
     _testdbclass = _SqliteTestDatabase
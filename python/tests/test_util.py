@@ -17,3 +17,23 @@ class TestUtil(unittest.TestCase):
         # calling again produces a different id
         ustr2 = util.uuid4_string()
         self.assertNotEqual(ustr, ustr2)
+
+    def test_docs_etag(self):
+        etag = util.docs_etag("ds_id", 3, 0, 10)
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        # same inputs, same etag
+        self.assertEqual(etag, util.docs_etag("ds_id", 3, 0, 10))
+        # any different input, different etag
+        self.assertNotEqual(etag, util.docs_etag("ds_id2", 3, 0, 10))
+        self.assertNotEqual(etag, util.docs_etag("ds_id", 4, 0, 10))
+        self.assertNotEqual(etag, util.docs_etag("ds_id", 3, 1, 10))
+        self.assertNotEqual(etag, util.docs_etag("ds_id", 3, 0, 11))
+
+    def test_etag_matches(self):
+        etag = util.docs_etag("ds_id", 3, 0, 10)
+        self.assertTrue(util.etag_matches(etag, etag))
+        self.assertTrue(util.etag_matches("*", etag))
+        self.assertTrue(util.etag_matches(f'"other", W/{etag}', etag))
+        self.assertFalse(util.etag_matches('"other"', etag))
+        self.assertFalse(util.etag_matches(None, etag))
+        self.assertFalse(util.etag_matches("", etag))